@@ -0,0 +1,127 @@
+from ipyleaflet import (
+    GeoJSON,
+    CircleMarker,
+    LayerGroup,
+    Popup,
+)
+from ipywidgets import HTML
+import numpy as np
+
+
+# Popups of at most this many points are kept in saved html. Each one is saved as four widgets (about 4.5 ms and 7 kB of
+# html per point), so larger layers are saved without popups.
+POPUP_EXPORT_LIMIT = 1000
+
+
+# Map mixin that draws points and segments as single GeoJSON layers, so the number of widgets does not grow with the
+# points. Popups of a layer are shown on click in one shared Popup by a Python callback, which does not run in saved
+# html. save therefore exports layers with popups as circle markers with their own popups, as they were drawn before the
+# layers, while they have up to popup_limit points in total, and puts the GeoJSON layers back afterwards.
+class FeatureLayers:
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.feature_popup = None
+        self.popup_layers = []
+
+    # colors is one color or one per point and popups one html text per point or None
+    def add_point_layer(self, points, colors, popups=None, radius=2, opacity=1.0, fill_opacity=0.2):
+        coordinates = np.column_stack([points['lon'], points['lat']]).tolist()
+        colors = np.broadcast_to(np.asarray(colors, dtype=object), (len(points),)).tolist()
+        features = [{
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': coordinates[i]},
+            'properties': {
+                'style': {'color': colors[i], 'fillColor': colors[i]},
+                'popup': popups[i] if popups is not None else None,
+            },
+        } for i in range(len(points))]
+        point_style = {'radius': radius, 'weight': 5, 'opacity': opacity, 'fillOpacity': fill_opacity}
+        return self.add_feature_layer(features, point_style=point_style)
+
+    # Adds one line per pair of consecutive points, colored by colors[i] for the line from point i, as a single GeoJSON
+    # layer
+    def add_segment_layer(self, points, colors, weight=2):
+        coordinates = np.column_stack([points['lon'], points['lat']])
+        segments = np.stack([coordinates[:-1], coordinates[1:]], axis=1).tolist()
+        features = [{
+            'type': 'Feature',
+            'geometry': {'type': 'LineString', 'coordinates': segments[i]},
+            'properties': {'style': {'color': colors[i], 'weight': weight, 'fill': False}},
+        } for i in range(len(segments))]
+        return self.add_feature_layer(features)
+
+    def add_feature_layer(self, features, point_style=None):
+        layer = GeoJSON(data={'type': 'FeatureCollection', 'features': features}, point_style=point_style or {})
+        if any(feature['properties'].get('popup') is not None for feature in features):
+            layer.on_click(self.show_feature_popup)
+            self.popup_layers.append(layer)
+        self.add(layer)
+        return layer
+
+    # Click handler of feature layers: moves the shared popup to the clicked feature and shows its text
+    def show_feature_popup(self, feature=None, properties=None, **kwargs):
+        if properties is None or properties.get('popup') is None:
+            return
+        lon, lat = feature['geometry']['coordinates'][:2]
+        if self.feature_popup is None:
+            self.feature_popup = Popup(
+                location=(lat, lon),
+                child=HTML(value=properties['popup']),
+                close_button=False,
+                auto_close=False,
+                close_on_escape_key=False
+            )
+            self.add(self.feature_popup)
+        else:
+            self.feature_popup.location = (lat, lon)
+            self.feature_popup.child.value = properties['popup']
+
+    def save(self, outfile, popup_limit=POPUP_EXPORT_LIMIT, **kwargs):
+        exported = []
+        for layer in self.popup_layers:
+            if layer not in self.layers:
+                continue
+            count = len(layer.data['features'])
+            if count > popup_limit:
+                print(f"Saving a layer of {count} points without popups, as it is over the limit of {popup_limit}")
+                continue
+            popup_limit -= count
+            exported.append((layer, self.marker_group(layer)))
+        for layer, group in exported:
+            self.substitute_layer(layer, group)
+        try:
+            super().save(outfile, **kwargs)
+        finally:
+            for layer, group in exported:
+                self.substitute_layer(group, layer)
+
+    # Circle markers of the point features of a layer, each with its popup bound to it so it is kept in saved html
+    @staticmethod
+    def marker_group(layer):
+        point_style = layer.point_style
+        markers = []
+        for feature in layer.data['features']:
+            if feature['geometry']['type'] != 'Point':
+                continue
+            lon, lat = feature['geometry']['coordinates'][:2]
+            properties = feature['properties']
+            style = properties.get('style', {})
+            marker = CircleMarker(
+                location=(lat, lon),
+                radius=point_style.get('radius', 2),
+                weight=point_style.get('weight', 5),
+                opacity=point_style.get('opacity', 1.0),
+                fill_opacity=point_style.get('fillOpacity', 0.2),
+                color=style.get('color', 'blue'),
+                fill_color=style.get('fillColor', style.get('color', 'blue')),
+            )
+            if properties.get('popup') is not None:
+                marker.popup = Popup(
+                    location=(lat, lon),
+                    child=HTML(value=properties['popup']),
+                    close_button=False,
+                    auto_close=False,
+                    close_on_escape_key=False
+                )
+            markers.append(marker)
+        return LayerGroup(layers=markers)
@@ -0,0 +1,111 @@
+import numpy as np
+from collections import defaultdict, deque
+
+
+# Lower bound on the meters in one degree of latitude, so expanded bounds never miss a neighbor
+METERS_PER_DEGREE = 110000.0
+
+
+# Uniform grid over (min_lon, min_lat, max_lon, max_lat) bounds.
+# Keys can be removed and reinserted with new bounds, so regions can be re-indexed as they grow by merging.
+class GridIndex:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = defaultdict(set)
+        self.key_cells = {}
+
+    def cells_of(self, bounds):
+        min_x, min_y, max_x, max_y = np.floor(np.asarray(bounds) / self.cell_size).astype(np.int64)
+        return [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+    def insert(self, key, bounds):
+        if key in self.key_cells:
+            self.remove(key)
+        cells = self.cells_of(bounds)
+        self.key_cells[key] = cells
+        for cell in cells:
+            self.cells[cell].add(key)
+
+    def remove(self, key):
+        for cell in self.key_cells.pop(key):
+            self.cells[cell].discard(key)
+
+    # Returns all keys in cells overlapping bounds. This is a superset of the keys whose bounds overlap.
+    def query(self, bounds):
+        keys = set()
+        for cell in self.cells_of(bounds):
+            keys.update(self.cells.get(cell, ()))
+        return keys
+
+
+# Grows bounds by meters in every direction
+def expand_bounds(bounds, meters):
+    min_x, min_y, max_x, max_y = bounds
+    lat_degrees = meters / METERS_PER_DEGREE
+    max_abs_lat = min(max(abs(min_y), abs(max_y)) + lat_degrees, 89.0)
+    lon_degrees = lat_degrees / np.cos(np.radians(max_abs_lat))
+    return min_x - lon_degrees, min_y - lat_degrees, max_x + lon_degrees, max_y + lat_degrees
+
+
+# Merges regions until no pair of them should be merged.
+# merge_key(new, existing) returns None if the later region new should not be merged into the earlier region existing,
+# or a key ranking the merge otherwise (0 for overlaps, the distance for close regions).
+# Regions are merged into the earliest one with union, as in the pairwise passes.
+def merge_regions(regions, merge_key, bounds, distance_threshold=0.0):
+    regions = list(regions)
+    if len(regions) <= 1:
+        return regions
+
+    def union(earlier, later):
+        regions[earlier] = regions[earlier].union(regions[later])
+        return bounds(regions[earlier])
+
+    groups = merge_groups([bounds(region) for region in regions],
+                          lambda later, earlier: merge_key(regions[later], regions[earlier]), union, distance_threshold)
+    return [regions[i] for i in range(len(regions)) if groups[i] == i]
+
+
+# Merges regions given by their indices until no pair of them should be merged, and returns the index of the region
+# each region was merged into. merge_key(later, earlier) ranks the merge of two indices as in merge_regions, and
+# union(earlier, later) merges the state the caller keeps for later into earlier and returns the new bounds of earlier.
+# Only regions whose bounds are within distance_threshold meters are compared, using a grid index that is updated when
+# a region grows. Every region starts on a work list and is put back on it whenever it absorbs another, so a single
+# sweep over the list reaches the state where repeated full merge passes would stop changing anything.
+def merge_groups(region_bounds, merge_key, union, distance_threshold=0.0):
+    region_bounds = list(region_bounds)
+    groups = np.arange(len(region_bounds))
+    if len(region_bounds) <= 1:
+        return groups
+
+    extents = [max(b[2] - b[0], b[3] - b[1]) for b in region_bounds]
+    margin = expand_bounds(region_bounds[0], distance_threshold)[2] - region_bounds[0][2]
+    # Cells of the median region size, or of the merge distance if that is larger, so one long region does not make
+    # every cell huge. Regions larger than a cell are inserted into every cell their bounds cover.
+    index = GridIndex(max(float(np.median(extents)), 2 * margin, 1e-5))
+    for i in range(len(region_bounds)):
+        index.insert(i, region_bounds[i])
+
+    work = deque(range(len(region_bounds)))
+    while len(work) > 0:
+        i = work.popleft()
+        if groups[i] != i:
+            continue
+        best = None
+        for j in sorted(index.query(expand_bounds(region_bounds[i], distance_threshold))):
+            if j == i:
+                continue
+            earlier, later = min(i, j), max(i, j)
+            key = merge_key(later, earlier)
+            if key is not None and (best is None or key < best[0]):
+                best = (key, earlier, later)
+        if best is None:
+            continue
+
+        _, earlier, later = best
+        region_bounds[earlier] = union(earlier, later)
+        groups[groups == later] = earlier
+        index.remove(later)
+        index.insert(earlier, region_bounds[earlier])
+        work.appendleft(earlier)
+
+    return groups
@@ -0,0 +1,85 @@
+import numpy as np
+
+
+# Equatorial radius used by gb-spm's distance_between_points
+EARTH_RADIUS = 6378137.0
+
+
+# Run-length table of a label vector over a trajectory.
+# Each row is a run of points with the same label: its start and end (exclusive) index, label, duration in seconds,
+# point count and path length in meters (computed on first use). Relabeling rows returns a new table with adjacent
+# runs of the same label joined, so operations like "stops shorter than 120 s become walks" are array updates on the
+# rows instead of loops over slices. The points of a run are only sliced out of the trajectory when asked for, as views.
+class SegmentTable:
+    def __init__(self, trajectory, starts, ends, labels, cumulative_distance_m=None):
+        self.trajectory = trajectory
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.labels = np.asarray(labels)
+        self._cumulative_distance_m = cumulative_distance_m
+
+        times = trajectory['time']
+        self.counts = self.ends - self.starts
+        self.durations = times[self.ends - 1] - times[self.starts]
+
+    # Meters traveled from the first point to each point. Taken from the distance field of significant-place-detection
+    # points if there is one, and computed with the haversine formula otherwise. Computed on first use and shared by the
+    # tables relabeled from this one.
+    @property
+    def cumulative_distance_m(self):
+        if self._cumulative_distance_m is None:
+            if 'distance' in self.trajectory.dtype.names:
+                self._cumulative_distance_m = np.cumsum(self.trajectory['distance']) - self.trajectory['distance'][:1]
+            else:
+                self._cumulative_distance_m = np.concatenate([[0.0], np.cumsum(step_distances_m(self.trajectory))])
+        return self._cumulative_distance_m
+
+    @property
+    def path_lengths_m(self):
+        return self.cumulative_distance_m[self.ends - 1] - self.cumulative_distance_m[self.starts]
+
+    @classmethod
+    def from_labels(cls, trajectory, labels, cumulative_distance_m=None):
+        labels = np.asarray(labels)
+        boundaries = np.nonzero(labels[1:] != labels[:-1])[0] + 1
+        starts = np.concatenate([[0], boundaries]) if len(labels) > 0 else np.zeros(0, dtype=np.int64)
+        ends = np.append(boundaries, len(labels)) if len(labels) > 0 else np.zeros(0, dtype=np.int64)
+        return cls(trajectory, starts, ends, labels[starts], cumulative_distance_m)
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Label of every point
+    def point_labels(self):
+        return np.repeat(self.labels, self.counts)
+
+    # Rows with the given label
+    def rows(self, label):
+        return np.nonzero(self.labels == label)[0]
+
+    # Table where the rows with mask True have the given label, with adjacent rows of the same label joined
+    def relabel(self, mask, label):
+        labels = np.where(mask, label, self.labels)
+        if len(labels) == 0:
+            return self
+        first = np.concatenate([[True], labels[1:] != labels[:-1]])
+        last = np.append(first[1:], True)
+        return SegmentTable(self.trajectory, self.starts[first], self.ends[last], labels[first],
+                            self._cumulative_distance_m)
+
+    # Points of row i, as a view of the trajectory
+    def segment(self, i):
+        return self.trajectory[self.starts[i]:self.ends[i]]
+
+    # Points of every row with the given label, or of every row if label is None
+    def segments(self, label=None):
+        rows = range(len(self)) if label is None else self.rows(label)
+        return (self.segment(i) for i in rows)
+
+
+# Meters from each point to the next
+def step_distances_m(trajectory):
+    lon = np.radians(trajectory['lon'])
+    lat = np.radians(trajectory['lat'])
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
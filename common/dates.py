@@ -0,0 +1,57 @@
+import numpy as np
+from datetime import datetime, timedelta
+
+
+# Epoch times of the midnights starting and ending date in tz (local time if tz is None)
+def day_bounds(date, tz=None):
+    next_date = date + timedelta(days=1)
+    start = datetime(date.year, date.month, date.day, tzinfo=tz)
+    end = datetime(next_date.year, next_date.month, next_date.day, tzinfo=tz)
+    return start.timestamp(), end.timestamp()
+
+
+# Index of day boundaries for fixes sorted by time, built with one binary search over all midnights.
+# Days run from midnight to midnight in tz (local time if tz is None, as in day_bounds), so a DST change gives a
+# 23 or 25 hour day. Every day or window is returned as a view, so iterating all days is O(N) in total.
+class DayPartition:
+    def __init__(self, points, tz=None, times=None):
+        self.points = points
+        self.times = points['time'] if times is None else times
+        self.tz = tz
+        if len(self.times) > 1 and np.any(self.times[1:] < self.times[:-1]):
+            raise ValueError("Points must be sorted by time")
+
+        if len(self.times) == 0:
+            self.dates = []
+            self.offsets = np.zeros(1, dtype=np.int64)
+        else:
+            start_date = self.date_of(self.times[0])
+            end_date = self.date_of(self.times[-1])
+            self.dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+            boundaries = [day_bounds(date, tz)[0] for date in self.dates]
+            boundaries.append(day_bounds(end_date, tz)[1])
+            self.offsets = np.searchsorted(self.times, boundaries, side='left')
+
+    def __len__(self):
+        return len(self.dates)
+
+    # Yields (date, points) for every date between the first and last fix, including days without fixes
+    def __iter__(self):
+        for i in range(len(self.dates)):
+            yield self.dates[i], self.points[self.offsets[i]:self.offsets[i + 1]]
+
+    def date_of(self, time):
+        return datetime.fromtimestamp(time, tz=self.tz).date()
+
+    def day(self, date):
+        if hasattr(date, 'date'):
+            date = date.date()
+        if len(self.dates) > 0 and self.dates[0] <= date <= self.dates[-1]:
+            i = (date - self.dates[0]).days
+            return self.points[self.offsets[i]:self.offsets[i + 1]]
+        return self.window(*day_bounds(date, self.tz))
+
+    # Returns the points with start_time <= time < end_time
+    def window(self, start_time, end_time):
+        start, end = np.searchsorted(self.times, [start_time, end_time], side='left')
+        return self.points[start:end]
@@ -0,0 +1,15 @@
+import shapely
+
+
+# Returns the vertices of the convex hull of (n, 2) coordinates. Collinear points give the two ends of their segment
+# and identical points give a single vertex.
+def hull_vertices(coordinates):
+    hull = shapely.convex_hull(shapely.multipoints(coordinates))
+    if hull.geom_type == 'Polygon':
+        return shapely.get_coordinates(hull)[:-1]
+    return shapely.get_coordinates(hull)
+
+
+# Returns the hull of hull vertices as a Polygon, LineString or Point
+def hull_shape(vertices):
+    return shapely.convex_hull(shapely.multipoints(vertices))
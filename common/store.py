@@ -0,0 +1,79 @@
+import os
+import json
+import numpy as np
+from datetime import datetime
+from dates import day_bounds, DayPartition
+
+
+# Store directory format shared by gb-spm and significant-place-detection, so a store written by one can be opened by
+# the other. Any position fix dtype can be stored; its fields are listed in the metadata.
+STORE_VERSION = 1
+POINTS_FILE = 'points.npy'
+TIME_INDEX_FILE = 'time.npy'
+METADATA_FILE = 'metadata.json'
+
+
+# Writes a time sorted structured array of position fixes to a store directory.
+# The points are kept as a single .npy file so a time window can be memory mapped as a view of position_fix_dtype.
+# A contiguous copy of the time column is written as the time index.
+def save_store(points, store_path, source=None, **parameters):
+    os.makedirs(store_path, exist_ok=True)
+
+    order = np.argsort(points['time'], kind='stable')
+    if np.any(order != np.arange(len(points))):
+        points = points[order]
+
+    np.save(os.path.join(store_path, POINTS_FILE), points)
+    np.save(os.path.join(store_path, TIME_INDEX_FILE), np.ascontiguousarray(points['time']))
+
+    metadata = {
+        'version': STORE_VERSION,
+        'source': source,
+        'source_mtime': os.path.getmtime(source) if source is not None else None,
+        'fields': list(points.dtype.names),
+        'count': len(points),
+        'start_time': float(points['time'][0]) if len(points) > 0 else None,
+        'end_time': float(points['time'][-1]) if len(points) > 0 else None,
+        'parameters': parameters,
+    }
+    with open(os.path.join(store_path, METADATA_FILE), 'w') as file:
+        json.dump(metadata, file, indent=2)
+
+
+class TrajectoryStore:
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, METADATA_FILE), 'r') as file:
+            self.metadata = json.load(file)
+        if self.metadata['version'] != STORE_VERSION:
+            raise ValueError(f"Unsupported store version {self.metadata['version']}")
+
+        # Nothing is read from disk until a slice is accessed
+        self.points = np.load(os.path.join(store_path, POINTS_FILE), mmap_mode='r')
+        self.times = np.load(os.path.join(store_path, TIME_INDEX_FILE), mmap_mode='r')
+        if self.points.dtype.names != tuple(self.metadata['fields']):
+            raise ValueError("Store fields do not match its metadata")
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, index):
+        return self.points[index]
+
+    # Returns a view of all points with start_time <= time < end_time
+    def window(self, start_time, end_time):
+        start, end = np.searchsorted(self.times, [start_time, end_time], side='left')
+        return self.points[start:end]
+
+    def day(self, date, tz=None):
+        return self.window(*day_bounds(date, tz))
+
+    # Day index of the whole store for iterating over every day
+    def days(self, tz=None):
+        return DayPartition(self.points, tz=tz, times=self.times)
+
+    # First and last date with fixes, with days from midnight to midnight in tz (local time if tz is None) as in day()
+    def get_date_range(self, tz=None):
+        start_date = datetime.fromtimestamp(self.metadata['start_time'], tz=tz).date()
+        end_date = datetime.fromtimestamp(self.metadata['end_time'], tz=tz).date()
+        return start_date, end_date
@@ -3,6 +3,9 @@ from ipyleaflet import CircleMarker, Popup, GeomanDrawControl, Polyline, Marker
 from datetime import datetime
 import numpy as np
 from ipywidgets import HTML
+import common_path  # noqa: F401
+from SegmentTable import SegmentTable
+from position_fix_utils import segment_directionality
 
 
 # move is 0/green, stop is 1/red
@@ -16,6 +19,8 @@ class LabelPlot(MapPlot):
         self.visible_start_index = 0
         self.visible_end_index = 0
 
+    # Points colored by label. With a click function every point is a marker that is hidden until show_time, as
+    # labeling changes single markers. Without one all points are drawn as a single layer.
     def add_points_clickable(self, points, function=None, time_popup=False, labels=None):
         self.points = points
         self.markers = []
@@ -24,11 +29,17 @@ class LabelPlot(MapPlot):
         else:
             self.labels = labels
 
+        if function is None:
+            colors = np.where(np.asarray(self.labels) == 1, 'red', 'green')
+            popups = self.time_popups(self.points) if time_popup else None
+            self.add_point_layer(self.points, colors, popups, fill_opacity=1.0)
+            self.set_coordinate_ranges(self.points)
+            return
+
         for i in range(len(self.points)):
             location = (self.points[i]['lat'], self.points[i]['lon'])
             color = 'red' if self.labels[i] == 1 else 'green'
-            opacity = 1 if function is None else 0
-            marker = CircleMarker(location=location, radius=2, color=color, opacity=opacity, fill_opacity=opacity)
+            marker = CircleMarker(location=location, radius=2, color=color, opacity=0, fill_opacity=0)
             if time_popup:
                 marker.popup = Popup(
                     location=location,
@@ -39,9 +50,8 @@ class LabelPlot(MapPlot):
                     auto_close=False,
                     close_on_escape_key=False
                 )
-            if function is not None:
-                marker.visible = False
-                marker.on_click(function)
+            marker.visible = False
+            marker.on_click(function)
             self.add(marker)
             self.markers.append(marker)
 
@@ -78,84 +88,52 @@ class LabelPlot(MapPlot):
             m.visible = False
             m.opacity = 0
 
+    # One polyline per run of labels, with moves and walks extended to the points around them so the curve is connected.
+    # With stop_markers, stops and walks get a marker with their times.
     def add_labeled_curve(self, trajectory, labels, stop_markers=False):
         point_list = trajectory.view((np.float64, len(trajectory.dtype.fields)))[:, 0:2].tolist()
-
-        current_label = labels[0]
-        current_segment = [point_list[0]]
-        for i in range(1, len(labels)):
-            if labels[i] != current_label or i == len(labels) - 1:
-                color = 'red' if current_label == 1 else 'green' if current_label == 0 else 'blue'
-                if True and stop_markers and current_label == 1:
-                    # Add POI marker
-                    location = current_segment[len(current_segment) // 2]
-                    poi_marker = Marker(location=location, draggable=True)
-
-                    enter_index = max(0, i - len(current_segment))
-                    exit_index = i
-                    enter_time = datetime.utcfromtimestamp(trajectory['time'][enter_index])
-                    exit_time = datetime.utcfromtimestamp(trajectory['time'][exit_index])
-                    time_diff = exit_time - enter_time
-                    hours = time_diff.seconds // 3600
-                    minutes = (time_diff.seconds % 3600) // 60
-                    seconds = time_diff.seconds % 60
-                    time_diff_formatted = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-
-                    times = (enter_time.strftime("%B %d %H:%M:%S") + " - "
-                             + exit_time.strftime("%H:%M:%S") + "<br>" + time_diff_formatted)
-                    poi_marker.popup = Popup(
-                        location=current_segment[-1],
-                        child=HTML(value=times),
-                        close_button=False,
-                        auto_close=False,
-                        close_on_escape_key=False
-                    )
-                    self.add(poi_marker)
-                elif True and stop_markers and current_label == 2:
-                    # Add POI marker
-                    location = current_segment[len(current_segment) // 2]
-                    poi_marker = Marker(location=location, draggable=True)
-
-                    enter_index = max(0, i - len(current_segment))
-                    exit_index = i
-                    enter_time = datetime.utcfromtimestamp(trajectory['time'][enter_index])
-                    exit_time = datetime.utcfromtimestamp(trajectory['time'][exit_index])
-                    time_diff = exit_time - enter_time
-                    hours = time_diff.seconds // 3600
-                    minutes = (time_diff.seconds % 3600) // 60
-                    seconds = time_diff.seconds % 60
-                    time_diff_formatted = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-                    from velocity_test import vector_directionality
-                    d = vector_directionality(trajectory[enter_index:exit_index])
-
-                    times = (enter_time.strftime("%B %d %H:%M:%S") + " - "
-                             + exit_time.strftime("%H:%M:%S") + "<br>" + time_diff_formatted
-                             + "<br>" + str(d))
-                    poi_marker.popup = Popup(
-                        location=current_segment[-1],
-                        child=HTML(value=times),
-                        close_button=False,
-                        auto_close=False,
-                        close_on_escape_key=False
-                    )
-                    self.add(poi_marker)
-                # add adjacent points
-                if current_label == 0 or current_label == 2:
-                    last_index = i - len(current_segment) - 1
-                    next_index = i
-                    if last_index >= 0:
-                        current_segment.insert(0, point_list[last_index])
-                    if next_index < len(point_list):
-                        current_segment.append(point_list[next_index])
-
-                polyline = Polyline(locations=current_segment, color=color, weight=2, fill=False)
-                self.add(polyline)
-                current_label = labels[i]
-                current_segment = []
-
-            current_segment.append(point_list[i])
+        table = SegmentTable.from_labels(trajectory, labels)
+        if stop_markers:
+            directionality = segment_directionality(trajectory, table.starts, table.ends)
+
+        for i, (label, start, end) in enumerate(zip(table.labels.tolist(), table.starts.tolist(),
+                                                    table.ends.tolist())):
+            color = 'red' if label == 1 else 'green' if label == 0 else 'blue'
+            if stop_markers and label in (1, 2):
+                text = "<br>" + str(directionality[i]) if label == 2 else ""
+                self.add_segment_marker(trajectory, start, end, point_list[start + (end - start) // 2],
+                                        point_list[end - 1], text)
+            # add adjacent points
+            if label == 0 or label == 2:
+                start, end = max(start - 1, 0), min(end + 1, len(point_list))
+            polyline = Polyline(locations=point_list[start:end], color=color, weight=2, fill=False)
+            self.add(polyline)
         self.set_coordinate_ranges(trajectory)
 
+    # POI marker from the first point of a run to the point after it, with a popup of the times
+    def add_segment_marker(self, trajectory, start, end, location, popup_location, text=""):
+        poi_marker = Marker(location=location, draggable=True)
+
+        exit_index = min(end, len(trajectory) - 1)
+        enter_time = datetime.utcfromtimestamp(trajectory['time'][start])
+        exit_time = datetime.utcfromtimestamp(trajectory['time'][exit_index])
+        time_diff = exit_time - enter_time
+        hours = time_diff.seconds // 3600
+        minutes = (time_diff.seconds % 3600) // 60
+        seconds = time_diff.seconds % 60
+        time_diff_formatted = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+        times = (enter_time.strftime("%B %d %H:%M:%S") + " - "
+                 + exit_time.strftime("%H:%M:%S") + "<br>" + time_diff_formatted + text)
+        poi_marker.popup = Popup(
+            location=popup_location,
+            child=HTML(value=times),
+            close_button=False,
+            auto_close=False,
+            close_on_escape_key=False
+        )
+        self.add(poi_marker)
+
     def add_shapes(self, shapes, color='red'):
         for shape in shapes:
             if hasattr(shape, 'geoms'):  # Check if the shape is a multi-part geometry
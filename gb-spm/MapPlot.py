@@ -1,6 +1,5 @@
 from ipyleaflet import (
     Map,
-    CircleMarker,
     Polyline,
     Popup,
     Marker,
@@ -10,9 +9,11 @@ import numpy as np
 from datetime import datetime
 import matplotlib.colors as mcolors
 from shapely.geometry import Polygon, LineString
+import common_path  # noqa: F401
+from FeatureLayers import FeatureLayers
 
 
-class MapPlot(Map):
+class MapPlot(FeatureLayers, Map):
     def __init__(self, height='1250px'):
         super().__init__(
             scroll_wheel_zoom=True,
@@ -21,24 +22,18 @@ class MapPlot(Map):
         self.current_bounds = None
 
     def add_points(self, points, time_popup=True, color='blue'):
-        for i in range(len(points)):
-            location = (points[i]['lat'], points[i]['lon'])
-            marker = CircleMarker(location=location, radius=2, color=color)
-
-            if time_popup:
-                marker.popup = Popup(
-                    location=location,
-                    child=HTML(value=(
-                            datetime.utcfromtimestamp(points[i]['time']).strftime("%B %d %H:%M:%S")
-                            + f"<br>Index: {i}")),
-                    close_button=False,
-                    auto_close=False,
-                    close_on_escape_key=False
-                )
-
-            self.add(marker)
+        popups = self.time_popups(points) if time_popup else None
+        self.add_point_layer(points, color, popups)
         self.set_coordinate_ranges(points)
 
+    # Popup text of each point with its time and index, and extra[i] after them if given
+    @staticmethod
+    def time_popups(points, extra=None):
+        times = [datetime.utcfromtimestamp(time).strftime("%B %d %H:%M:%S") for time in points['time'].tolist()]
+        if extra is None:
+            return [f"{times[i]}<br>Index: {i}" for i in range(len(times))]
+        return [f"{times[i]}{extra[i]}<br>Index: {i}" for i in range(len(times))]
+
     def add_curve(self, points, color='blue'):
         point_list = points.view((np.float64, len(points.dtype.fields)))[:, 0:2].tolist()
         polyline = Polyline(locations=point_list, color=color, weight=1, fill=False)
@@ -47,32 +42,17 @@ class MapPlot(Map):
 
     def add_curve_heat(self, points, keys, normalization='linear'):
         colors = self.get_color_range(keys, normalization)
-        point_list = points.view((np.float64, 4))[:, 0:2].tolist()
-
-        # Add circle markers with colors corresponding to the heatmap
-        for i in range(len(point_list) - 1):
-            polyline = Polyline(locations=point_list[i:i+2], color=colors[i], weight=2, fill=False)
-            self.add(polyline)
+        # Lines with colors corresponding to the heatmap
+        self.add_segment_layer(points, colors)
 
     def add_points_heat(self, points, keys, time_popup=True, normalization='linear'):
         colors = self.get_color_range(keys, normalization)
 
-        # Add circle markers with colors corresponding to the heatmap
-        for i in range(len(points)):
-            location = (points[i]['lat'], points[i]['lon'])
-            marker = CircleMarker(location=location, radius=2, color=colors[i])
-
-            if time_popup:
-                marker.popup = Popup(
-                    location=location,
-                    child=HTML(value=datetime.utcfromtimestamp(points[i]['time']).strftime("%B %d %H:%M:%S") +
-                               f"<br>Key: {keys[i]:.2f}<br>Index: {i}"),
-                    close_button=False,
-                    auto_close=False,
-                    close_on_escape_key=False
-                )
-
-            self.add(marker)
+        # Add circles with colors corresponding to the heatmap
+        popups = None
+        if time_popup:
+            popups = self.time_popups(points, [f"<br>Key: {key:.2f}" for key in np.asarray(keys).tolist()])
+        self.add_point_layer(points, colors, popups)
 
         # Update coordinate ranges
         self.set_coordinate_ranges(points)
@@ -0,0 +1,118 @@
+import numpy as np
+from position_fix_utils import position_fix_dtype, smooth_trajectory
+from TrajectoryContext import TrajectoryContext
+from gb_spm import characteristic_indices, significant_place_mining
+
+
+# GB-SPM over position fixes that arrive in batches.
+# Fixes are kept in a buffer that is smoothed and searched for characteristic points (CPs) on every push. Once the time
+# from a CP to the next one is longer than close_time, the person has left, so the stops made of the CPs before that
+# gap are mined and returned as closed, and the buffer is cut there. Only the last cp_r_index points before the cut are
+# kept as context for the neighborhood velocities, so the work per push depends on the buffer and not on the day.
+# If no gap closes the buffer within max_window seconds, it is cut at its end and a long stop is returned in pieces.
+# CPs within cp_r_index points of the end of the buffer are not used to find gaps, since their neighborhoods are not
+# complete yet.
+# Unlike a batch run, stops on either side of a cut are never merged, even if they are at the same place.
+# Each push re-smooths the whole buffer and searches it for CPs, so its cost grows with the buffer up to max_window seconds of
+# fixes (about 6 hours by default) while no gap closes it. Latency is bounded by max_window, not by the size of a push;
+# lower max_window for tighter latency at the price of more stops split at cuts.
+class OnlineGBSPM:
+    def __init__(self, close_time=600, max_window=6 * 3600, cp_r_index=4, max_velocity=1, r_index=3, max_dist=0.25,
+                 max_time=120, dist_mult=60, s=5e-11, weight='inverse', smoothing_r_index=1):
+        self.close_time = close_time
+        self.max_window = max_window
+        self.cp_r_index = cp_r_index
+        self.max_velocity = max_velocity
+        self.r_index = r_index
+        self.max_dist = max_dist
+        self.max_time = max_time
+        self.dist_mult = dist_mult
+        self.s = s
+        self.weight = weight
+        self.smoothing_r_index = smoothing_r_index
+
+        self.buffer = np.zeros(0, dtype=position_fix_dtype)
+        # Points before this index are context kept from the last cut and cannot be CPs
+        self.context_length = 0
+
+    # Adds fixes sorted by time and returns the stop regions closed by them
+    def push(self, fixes):
+        fixes = np.asarray(fixes)
+        if len(fixes) == 0:
+            return []
+        if len(self.buffer) > 0 and fixes['time'][0] < self.buffer['time'][-1]:
+            raise ValueError("Fixes must arrive in time order")
+        self.buffer = np.concatenate([self.buffer, fixes.astype(position_fix_dtype)])
+        if not self.has_enough_points():
+            return []
+
+        smoothed, cp_indices = self.characteristic_points()
+        stable_end = len(smoothed) - self.cp_r_index
+        stable = cp_indices[cp_indices < stable_end]
+
+        cut = self.find_cut(smoothed, stable, stable_end)
+        if cut is None:
+            return []
+        return self.close(smoothed, cp_indices[cp_indices < cut], cut)
+
+    # Closes every stop in the buffer and empties it
+    def flush(self):
+        if not self.has_enough_points():
+            self.reset()
+            return []
+        smoothed, cp_indices = self.characteristic_points()
+        stop_regions = self.mine(smoothed, cp_indices)
+        self.reset()
+        return stop_regions
+
+    # Stops in the buffer that are not closed yet. They can still grow or change as fixes arrive.
+    def open_regions(self):
+        if not self.has_enough_points():
+            return []
+        smoothed, cp_indices = self.characteristic_points()
+        return self.mine(smoothed, cp_indices)
+
+    # Neighborhoods need a full cp_r_index points on either side of at least one point after the context
+    def has_enough_points(self):
+        return len(self.buffer) - self.context_length > max(2 * self.cp_r_index, 3)
+
+    def reset(self):
+        self.buffer = np.zeros(0, dtype=position_fix_dtype)
+        self.context_length = 0
+
+    # Smoothed buffer and the indices of its CPs after the context
+    def characteristic_points(self):
+        smoothed = smooth_trajectory(self.buffer, s=self.s * len(self.buffer), weight=self.weight,
+                                     r_index=self.smoothing_r_index)
+        cp_indices = characteristic_indices(smoothed, self.cp_r_index, self.max_velocity,
+                                            context=TrajectoryContext(smoothed))
+        return smoothed, cp_indices[cp_indices >= self.context_length]
+
+    # Index of the first point after the last gap longer than close_time between stable CPs, or stable_end if the
+    # buffer is longer than max_window. None if the buffer should not be cut yet.
+    def find_cut(self, smoothed, stable, stable_end):
+        times = smoothed['time']
+        # The end of the stable points ends the gap after the last CP
+        boundaries = np.append(stable, stable_end)
+        gaps = np.diff(times[boundaries])
+        moved = np.diff(boundaries) > 1
+        closing = np.nonzero((gaps > self.close_time) & moved)[0]
+        if len(closing) > 0:
+            return boundaries[closing[-1] + 1]
+        if times[-1] - times[self.context_length] > self.max_window and stable_end > self.context_length:
+            return stable_end
+        return None
+
+    # Mines the CPs before cut and keeps the points after it with cp_r_index points of context
+    def close(self, smoothed, cp_indices, cut):
+        stop_regions = self.mine(smoothed, cp_indices)
+        context_start = max(cut - self.cp_r_index, 0)
+        self.buffer = self.buffer[context_start:].copy()
+        self.context_length = cut - context_start
+        return stop_regions
+
+    def mine(self, smoothed, cp_indices):
+        if len(cp_indices) == 0:
+            return []
+        return significant_place_mining(smoothed, cp_indices, self.r_index, self.max_dist, self.max_time,
+                                        self.dist_mult, context=TrajectoryContext(smoothed))
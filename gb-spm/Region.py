@@ -1,70 +1,89 @@
+import shapely
 from shapely.geometry import Point, LineString
 import numpy as np
 from geopy import distance
+import common_path  # noqa: F401
+from GridIndex import merge_regions
+from hull import hull_vertices, hull_shape
 
 
 def recursive_merge(stop_regions, distance_threshold=0.0):
-    merged = merge_stop_regions(stop_regions, distance_threshold=distance_threshold)
-    if len(merged) == len(stop_regions):
-        return stop_regions
-    else:
-        return recursive_merge(merged, distance_threshold)
+    return merge_stop_regions(stop_regions, distance_threshold=distance_threshold)
 
 
 # Function to merge point clouds based if they overlap or if centroids are close
+# Overlapping regions are merged first, then the closest region under distance_threshold
 def merge_stop_regions(stop_regions, distance_threshold=0.0, overlap_threshold=0.0):
-    merged_stops = [stop_regions[0]]
-    for stop in stop_regions[1:]:
-        merged = False
-        min_distance = None
-        min_distance_index = None
-        for i in range(len(merged_stops)):
-            percent_intersection = stop.percent_intersection(merged_stops[i])
-            if percent_intersection > overlap_threshold:
-                merged_stops[i] = merged_stops[i].union(stop)
-                merged = True
-                break
-            if distance_threshold > 0.0:
-                dist = distance.distance((stop.centroid.y, stop.centroid.x), (merged_stops[i].centroid.y, merged_stops[i].centroid.x)).meters
-                if min_distance is None or dist < min_distance:
-                    min_distance = dist
-                    min_distance_index = i
-        # If no intersections, merge with the closest region if under distance_threshold
-        if not merged and min_distance is not None and min_distance < distance_threshold:
-            merged_stops[min_distance_index] = merged_stops[min_distance_index].union(stop)
-            merged = True
-
-        # Make a new region if not merged
-        if not merged:
-            merged_stops.append(stop)
-    return merged_stops
+    def merge_key(stop, merged_stop):
+        if stop.percent_intersection(merged_stop) > overlap_threshold:
+            return 0.0
+        if distance_threshold > 0.0:
+            dist = distance.distance((stop.centroid.y, stop.centroid.x),
+                                     (merged_stop.centroid.y, merged_stop.centroid.x)).meters
+            if dist < distance_threshold:
+                return dist
+        return None
 
+    return merge_regions(stop_regions, merge_key, lambda region: region.shape.bounds, distance_threshold)
 
+
+# Overlap of each pair of shapes in two arrays, as Region.percent_intersection gives it for one pair: the intersected
+# length over the shorter length if they meet in lines, 1 if they meet at a point and the intersected area over the
+# smaller area otherwise. All pairs are intersected in one shapely call.
+def intersection_ratios(shapes, others):
+    intersections = shapely.intersection(shapes, others)
+    types = shapely.get_type_id(intersections)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        line_ratios = shapely.length(intersections) / np.minimum(shapely.length(shapes), shapely.length(others))
+        area_ratios = shapely.area(intersections) / np.minimum(shapely.area(shapes), shapely.area(others))
+    is_line = (types == shapely.GeometryType.LINESTRING) | (types == shapely.GeometryType.MULTILINESTRING)
+    return np.where(is_line, line_ratios, np.where(types == shapely.GeometryType.POINT, 1.0, area_ratios))
+
+
+# Stop regions (label 1) keep the vertices of their convex hull and running sums of their points, so a union is the
+# hull of both hulls and the centroid is the mean of the points. Points are only concatenated when they are accessed.
 class Region:
     def __init__(self, points, label):
-        self.points = points
+        self.point_chunks = [points]
         self.entry_times = [points[0]['time']]
         self.exit_times = [points[-1]['time']]
         self.label = label
 
-        lon_lats = [list(i) for i in self.points[['lon', 'lat']]]
-        dist = distance.distance(self.points[['lon', 'lat']][0], self.points[['lon', 'lat']][-1]).meters
-        shape = LineString(lon_lats) if dist != 0 else Point(lon_lats[0])
-        self.centroid = shape.centroid
+        lon_lats = np.column_stack([points['lon'], points['lat']])
+        self.count = len(lon_lats)
+        self.coordinate_sum = lon_lats.sum(axis=0)
+        self.hull = hull_vertices(lon_lats)
+        self.centroid = Point(self.coordinate_sum / self.count)
+
         # Convert to convex hull for stops or linestring for walks/moves
-        self.shape = shape.convex_hull if label == 1 else shape
+        if np.array_equal(lon_lats[0], lon_lats[-1]):
+            self.shape = Point(lon_lats[0])
+        elif label == 1:
+            self.shape = hull_shape(self.hull)
+        else:
+            self.shape = LineString(lon_lats)
+
+    @property
+    def points(self):
+        if len(self.point_chunks) > 1:
+            self.point_chunks = [np.concatenate(self.point_chunks)]
+        return self.point_chunks[0]
 
     def union(self, other, new_label=1):
-        self.points = np.append(self.points, other.points)
+        self.point_chunks.extend(other.point_chunks)
         self.entry_times.extend(other.entry_times)
         self.exit_times.extend(other.exit_times)
         self.label = new_label
 
-        lon_lats = [list(i) for i in self.points[['lon', 'lat']]]
-        shape = LineString(lon_lats)
-        self.centroid = shape.centroid
+        self.count += other.count
+        self.coordinate_sum = self.coordinate_sum + other.coordinate_sum
+        self.hull = hull_vertices(np.concatenate([self.hull, other.hull]))
+        self.centroid = Point(self.coordinate_sum / self.count)
         # Convert to convex hull for stops or linestring for walks/moves
-        self.shape = shape.convex_hull if new_label == 1 else shape
+        if new_label == 1:
+            self.shape = hull_shape(self.hull)
+        else:
+            self.shape = LineString(np.column_stack([self.points['lon'], self.points['lat']]))
 
         return self
 
@@ -72,7 +91,6 @@ class Region:
         intersection = self.shape.intersection(other.shape)
 
         if intersection.geom_type in ['LineString', 'MultiLineString']:
-            print(self.shape.length, self.shape.geom_type, other.shape.length, other.shape.geom_type)
             return intersection.length / min(self.shape.length, other.shape.length)
         elif intersection.geom_type == 'Point':
             return 1.0
@@ -83,7 +101,6 @@ class Region:
         intersection = self.shape.intersection(path.shape)
 
         if intersection.geom_type in ['LineString', 'MultiLineString']:
-            print(intersection.length, path.shape.length, intersection.length / path.shape.length)
             return intersection.length / path.shape.length
         elif intersection.geom_type == 'Point':
             return float(path.shape.geom_type == 'Point')
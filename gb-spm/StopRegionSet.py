@@ -0,0 +1,153 @@
+import numpy as np
+from shapely.geometry import MultiPoint
+from StopRegion import StopRegion
+from position_fix_utils import position_fix_dtype
+
+
+# Columnar collection of stop regions.
+# The points of all regions are stored in one array sorted by region, with point_offsets marking where each region
+# starts, and the visits (entry and exit times) of all regions likewise in flat arrays with visit_offsets. Centroids
+# and bounding boxes are arrays over the regions. Filters and merges are array operations that return a new set, and
+# shapely geometry or StopRegion objects are only built when asked for.
+class StopRegionSet:
+    def __init__(self, points, point_offsets, entry_times, exit_times, visit_offsets):
+        self.points = points
+        self.point_offsets = np.asarray(point_offsets, dtype=np.int64)
+        self.entry_times = np.asarray(entry_times, dtype=np.float64)
+        self.exit_times = np.asarray(exit_times, dtype=np.float64)
+        self.visit_offsets = np.asarray(visit_offsets, dtype=np.int64)
+
+        counts = np.diff(self.point_offsets)
+        starts = self.point_offsets[:-1]
+        if len(counts) > 0:
+            self.centroids = np.column_stack([np.add.reduceat(points['lon'], starts),
+                                              np.add.reduceat(points['lat'], starts)]) / counts[:, np.newaxis]
+            self.bboxes = np.column_stack([np.minimum.reduceat(points['lon'], starts),
+                                           np.minimum.reduceat(points['lat'], starts),
+                                           np.maximum.reduceat(points['lon'], starts),
+                                           np.maximum.reduceat(points['lat'], starts)])
+        else:
+            self.centroids = np.zeros((0, 2))
+            self.bboxes = np.zeros((0, 4))
+
+    # Each region has one visit from its first to its last point.
+    # labels gives the region of every point and regions are numbered in order of their first point.
+    @classmethod
+    def from_labels(cls, points, labels):
+        order = np.argsort(labels, kind='stable')
+        points = points[order]
+        labels = np.asarray(labels)[order]
+        point_offsets = np.searchsorted(labels, np.arange(labels[-1] + 1 if len(labels) > 0 else 0), side='left')
+        point_offsets = np.append(point_offsets, len(points))
+        entry_times = points['time'][point_offsets[:-1]]
+        exit_times = points['time'][point_offsets[1:] - 1]
+        return cls(points, point_offsets, entry_times, exit_times, np.arange(len(entry_times) + 1))
+
+    @classmethod
+    def from_stop_regions(cls, stop_regions):
+        if len(stop_regions) == 0:
+            return cls(np.zeros(0, dtype=position_fix_dtype), [0], [], [], [0])
+        points = np.concatenate([stop_region.points for stop_region in stop_regions])
+        point_offsets = np.cumsum([0] + [len(stop_region.points) for stop_region in stop_regions])
+        entry_times = np.concatenate([np.asarray(stop_region.entry_times, dtype=np.float64)
+                                      for stop_region in stop_regions])
+        exit_times = np.concatenate([np.asarray(stop_region.exit_times, dtype=np.float64)
+                                     for stop_region in stop_regions])
+        visit_offsets = np.cumsum([0] + [len(stop_region.entry_times) for stop_region in stop_regions])
+        return cls(points, point_offsets, entry_times, exit_times, visit_offsets)
+
+    def __len__(self):
+        return len(self.point_offsets) - 1
+
+    # Region of every point
+    @property
+    def point_region(self):
+        return np.repeat(np.arange(len(self)), np.diff(self.point_offsets))
+
+    # Region of every visit
+    @property
+    def visit_region(self):
+        return np.repeat(np.arange(len(self)), np.diff(self.visit_offsets))
+
+    # Time from the first entry to the last exit of each region
+    def durations(self):
+        return self.exit_times[self.visit_offsets[1:] - 1] - self.entry_times[self.visit_offsets[:-1]]
+
+    # Longest visit of each region
+    def stay_times(self):
+        return np.maximum.reduceat(self.exit_times - self.entry_times, self.visit_offsets[:-1])
+
+    # Set of the regions where keep is True
+    def filter(self, keep):
+        keep = np.asarray(keep, dtype=bool)
+        point_keep = np.repeat(keep, np.diff(self.point_offsets))
+        visit_keep = np.repeat(keep, np.diff(self.visit_offsets))
+        point_offsets = np.concatenate([[0], np.cumsum(np.diff(self.point_offsets)[keep])])
+        visit_offsets = np.concatenate([[0], np.cumsum(np.diff(self.visit_offsets)[keep])])
+        return StopRegionSet(self.points[point_keep], point_offsets, self.entry_times[visit_keep],
+                             self.exit_times[visit_keep], visit_offsets)
+
+    # Set where every visit j with joins_next[j] ends at the exit of visit j + 1 of the same region
+    def join_visits(self, joins_next):
+        joins_next = np.asarray(joins_next, dtype=bool).copy()
+        if len(joins_next) == 0:
+            return self
+        # The last visit of a region has no next visit in it
+        joins_next[self.visit_offsets[1:] - 1] = False
+        keeps_entry = np.concatenate([[True], ~joins_next[:-1]])
+        keeps_exit = ~joins_next
+        visit_region = self.visit_region
+        visit_counts = np.bincount(visit_region[keeps_entry], minlength=len(self))
+        return StopRegionSet(self.points, self.point_offsets, self.entry_times[keeps_entry],
+                             self.exit_times[keeps_exit], np.concatenate([[0], np.cumsum(visit_counts)]))
+
+    # Set where visit j belongs to region visit_regions[j]. The visits of each region are ordered by keys.
+    # Regions left without visits must be filtered out before durations or stay times are taken.
+    def assign_visits(self, visit_regions, keys):
+        order = np.lexsort((keys, visit_regions))
+        counts = np.bincount(visit_regions, minlength=len(self))
+        return StopRegionSet(self.points, self.point_offsets, self.entry_times[order], self.exit_times[order],
+                             np.concatenate([[0], np.cumsum(counts)]))
+
+    # Set with the visits of each region sorted by entry time
+    def sort_visits(self):
+        return self.assign_visits(self.visit_region, self.entry_times)
+
+    # Visits of all regions sorted by entry time and, separately, by exit time.
+    # Returns the visit indices in each order, so the visits just before or after a time are found by binary search.
+    def timeline(self):
+        return np.argsort(self.entry_times, kind='stable'), np.argsort(self.exit_times, kind='stable')
+
+    # Set where the regions with the same group are one region, in order of their first region.
+    # Points and visits of a merged region are in the order of the regions merged into it.
+    def merge(self, groups):
+        _, first_index, group_ids = np.unique(groups, return_index=True, return_inverse=True)
+        # Number groups in order of their first region
+        rank = np.empty(len(first_index), dtype=np.int64)
+        rank[np.argsort(first_index)] = np.arange(len(first_index))
+        group_ids = rank[group_ids]
+
+        point_order = np.argsort(group_ids[self.point_region], kind='stable')
+        visit_order = np.argsort(group_ids[self.visit_region], kind='stable')
+        point_counts = np.bincount(group_ids, weights=np.diff(self.point_offsets)).astype(np.int64)
+        visit_counts = np.bincount(group_ids, weights=np.diff(self.visit_offsets)).astype(np.int64)
+        return StopRegionSet(self.points[point_order], np.concatenate([[0], np.cumsum(point_counts)]),
+                             self.entry_times[visit_order], self.exit_times[visit_order],
+                             np.concatenate([[0], np.cumsum(visit_counts)]))
+
+    def region_points(self, i):
+        return self.points[self.point_offsets[i]:self.point_offsets[i + 1]]
+
+    def convex_hull(self, i):
+        points = self.region_points(i)
+        return MultiPoint(np.column_stack([points['lon'], points['lat']])).convex_hull
+
+    # StopRegion objects of all regions, for plotting and other code that works on single regions
+    def to_stop_regions(self):
+        stop_regions = []
+        for i in range(len(self)):
+            stop_region = StopRegion(self.region_points(i))
+            stop_region.entry_times = list(self.entry_times[self.visit_offsets[i]:self.visit_offsets[i + 1]])
+            stop_region.exit_times = list(self.exit_times[self.visit_offsets[i]:self.visit_offsets[i + 1]])
+            stop_regions.append(stop_region)
+        return stop_regions
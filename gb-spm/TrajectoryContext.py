@@ -0,0 +1,67 @@
+import numpy as np
+from position_fix_utils import distance_between_points, distance_between_arrays
+
+
+# Quantities derived from one trajectory, computed lazily and memoized by their parameters so that every GB-SPM stage
+# run on the same trajectory shares them instead of recomputing them.
+class TrajectoryContext:
+    def __init__(self, trajectory):
+        self.trajectory = trajectory
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.trajectory)
+
+    def memoize(self, key, compute):
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+    # Context of trajectory[indices], keyed on the identity of the indices array.
+    # The indices are kept in the cache so their id cannot be reused while the context is alive.
+    def subset(self, indices):
+        return self.memoize(('subset', id(indices)),
+                            lambda: (indices, TrajectoryContext(self.trajectory[indices])))[1]
+
+    # km distances between consecutive points
+    def distances(self):
+        return self.memoize(('distances',), lambda: distance_between_points(self.trajectory))
+
+    # km traveled from the first point to each point
+    def cumulative_distance(self):
+        return self.memoize(('cumulative_distance',), lambda: np.concatenate([[0.0], np.cumsum(self.distances())]))
+
+    # Seconds between consecutive points
+    def time_diffs(self):
+        return self.memoize(('time_diffs',), lambda: np.diff(self.trajectory['time']))
+
+    # Total time of the neighborhood of each point, see gb_spm.neighborhood_stay_times
+    def stay_times(self, r_index, unit='sec'):
+        seconds = self.memoize(('stay_times', r_index), lambda: neighborhood_time_diffs(self.trajectory, r_index))
+        if unit == 'sec':
+            return seconds
+        elif unit == 'min':
+            return self.memoize(('stay_times', r_index, unit), lambda: seconds / 60)
+        elif unit == 'hr':
+            return self.memoize(('stay_times', r_index, unit), lambda: seconds / 3600)
+        else:
+            raise ValueError('Unit must be sec, min, or hr.')
+
+    # km distance from each point to the point k places later in column k - 1, NaN past the end of the trajectory
+    def band_distances(self, r_index):
+        def compute():
+            band = np.full((len(self.trajectory), r_index), np.nan)
+            for k in range(1, min(r_index, len(self.trajectory) - 1) + 1):
+                band[:-k, k - 1] = distance_between_arrays(self.trajectory[k:], self.trajectory[:-k])
+            return band
+        return self.memoize(('band_distances', r_index), compute)
+
+
+# Time between the first and last point of the 2 * r_index + 1 point neighborhood of each point
+def neighborhood_time_diffs(trajectory, r_index):
+    times = trajectory['time']
+    padded_time = np.pad(times, (r_index, r_index), mode='edge')
+    time_kernel = np.zeros(2 * r_index + 1)
+    time_kernel[0] = 1
+    time_kernel[-1] = -1
+    return np.convolve(padded_time, time_kernel, mode='valid')
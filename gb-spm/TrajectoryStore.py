@@ -0,0 +1,45 @@
+import os
+import json
+from position_fix_utils import position_fix_from_csv
+import common_path  # noqa: F401
+from store import STORE_VERSION, METADATA_FILE, save_store, TrajectoryStore
+
+
+# Converts a device csv to a store. Parsing happens once here instead of on every run.
+def convert_csv(file_path, store_path=None, remove_duplicates=True, accuracy_threshold=None):
+    if store_path is None:
+        store_path = default_store_path(file_path, accuracy_threshold)
+    points = position_fix_from_csv(file_path, remove_duplicates=remove_duplicates,
+                                   accuracy_threshold=accuracy_threshold)
+    save_store(points, store_path, source=os.path.abspath(file_path),
+               remove_duplicates=remove_duplicates, accuracy_threshold=accuracy_threshold)
+    return store_path
+
+
+def default_store_path(file_path, accuracy_threshold=None):
+    root, _ = os.path.splitext(file_path)
+    suffix = '' if accuracy_threshold is None else f'-acc{accuracy_threshold:g}'
+    return root + suffix + '.store'
+
+
+# Opens the store for a csv, converting it first if the store is missing or older than the csv
+def open_store(file_path, remove_duplicates=True, accuracy_threshold=None):
+    store_path = default_store_path(file_path, accuracy_threshold)
+    metadata_path = os.path.join(store_path, METADATA_FILE)
+    stale = True
+    if os.path.exists(metadata_path):
+        with open(metadata_path, 'r') as file:
+            metadata = json.load(file)
+        stale = (metadata.get('version') != STORE_VERSION
+                 or metadata.get('source_mtime') is None
+                 or metadata['source_mtime'] < os.path.getmtime(file_path)
+                 or metadata['parameters'].get('remove_duplicates') != remove_duplicates)
+    if stale:
+        convert_csv(file_path, store_path, remove_duplicates=remove_duplicates, accuracy_threshold=accuracy_threshold)
+    return TrajectoryStore(store_path)
+
+
+if __name__ == '__main__':
+    from utils import absolute_path
+    path = convert_csv(absolute_path("../data/andrew-device-locations-all.csv"), accuracy_threshold=80)
+    print("Wrote", len(TrajectoryStore(path)), "points to", path)
@@ -0,0 +1,123 @@
+import sys
+import csv
+import numpy as np
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+from TrajectoryStore import open_store
+from position_fix_utils import DayPartition
+from gb_spm import detect_stop_regions
+
+
+output_fields = ['device', 'date', 'stop', 'visit', 'entry_time', 'exit_time', 'centroid_lat', 'centroid_lon',
+                 'points']
+
+
+# Headless GB-SPM over many devices and days.
+# devices maps a device name to its csv. The points of every device are copied once into a shared memory block and each
+# (device, day) job only sends the name of the block and the offsets of its day, so no trajectory is pickled.
+# Jobs run on up to workers processes (one per core if None). Their stop regions are written to a single csv at
+# output_path with one row per visit, in device and date order. Days from start_date to end_date (inclusive, all days if
+# None) with fewer than min_points fixes are skipped. parameters are passed to gb_spm.detect_stop_regions.
+def run_batch(devices, output_path, start_date=None, end_date=None, workers=None, accuracy_threshold=80, tz=None,
+              min_points=4, **parameters):
+    blocks = []
+    try:
+        jobs = []
+        for device, file_path in devices.items():
+            points = open_store(file_path, accuracy_threshold=accuracy_threshold).points
+            if len(points) == 0:
+                continue
+            block = share_points(points)
+            blocks.append(block)
+            jobs.extend(day_jobs(device, points, block.name, start_date, end_date, tz, min_points, parameters))
+
+        with open(output_path, 'w', newline='') as file, ProcessPoolExecutor(max_workers=workers) as executor:
+            writer = csv.writer(file)
+            writer.writerow(output_fields)
+            for rows in executor.map(run_day, jobs):
+                writer.writerows(rows)
+    finally:
+        for block in blocks:
+            release_points(block)
+    return len(jobs)
+
+
+# Copies points into a new shared memory block. The caller closes and unlinks it when its jobs are done.
+def share_points(points):
+    block = shared_memory.SharedMemory(create=True, size=max(points.nbytes, 1))
+    np.ndarray(points.shape, dtype=points.dtype, buffer=block.buf)[:] = points
+    return block
+
+
+# Opens a block made by share_points in a worker. The parent owns the block and unlinks it, so the worker does not
+# register it with the resource tracker, which would otherwise report it as leaked or unlink it when the worker exits.
+# Workers started on POSIX share the tracker of the parent, so unregistering there also drops the parent's entry, which
+# release_points adds back before unlinking.
+def attach_points(block_name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=block_name, track=False)
+    block = shared_memory.SharedMemory(name=block_name)
+    resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+# Closes and unlinks a block made by share_points in the parent, once its workers are done
+def release_points(block):
+    block.close()
+    if sys.version_info < (3, 13):
+        resource_tracker.register(block._name, 'shared_memory')
+    block.unlink()
+
+
+# View of the count points in a block made by share_points. Views must be deleted before the block is closed.
+def shared_points(block, dtype_descr, count):
+    return np.ndarray((count,), dtype=np.dtype(dtype_descr), buffer=block.buf)
+
+
+# Jobs of the days of one device in shared memory
+def day_jobs(device, points, block_name, start_date, end_date, tz, min_points, parameters):
+    jobs = []
+    days = DayPartition(points, tz=tz)
+    for i, day in enumerate(days.dates):
+        start, end = days.offsets[i], days.offsets[i + 1]
+        if end - start < min_points:
+            continue
+        if (start_date is not None and day < as_date(start_date)) or (end_date is not None and day > as_date(end_date)):
+            continue
+        jobs.append((device, day.isoformat(), block_name, points.dtype.descr, len(points), int(start), int(end),
+                     parameters))
+    return jobs
+
+
+def as_date(value):
+    return value.date() if hasattr(value, 'date') else value
+
+
+# Runs one job on a worker and returns its csv rows
+def run_day(job):
+    device, day, block_name, dtype_descr, count, start, end, parameters = job
+    block = attach_points(block_name)
+    try:
+        points = shared_points(block, dtype_descr, count)
+        stop_regions = detect_stop_regions(points[start:end], **parameters)
+        del points
+        return stop_region_rows(device, day, stop_regions)
+    finally:
+        block.close()
+
+
+def stop_region_rows(device, day, stop_regions):
+    rows = []
+    for i, stop_region in enumerate(stop_regions):
+        centroid = stop_region.centroid()
+        for j in range(len(stop_region.entry_times)):
+            rows.append([device, day, i, j, stop_region.entry_times[j], stop_region.exit_times[j], centroid.y,
+                         centroid.x, len(stop_region.points)])
+    return rows
+
+
+if __name__ == '__main__':
+    from utils import absolute_path
+    run_batch({'andrew': absolute_path("../data/andrew-device-locations-all.csv")},
+              absolute_path("stop_regions.csv"), start_date=date(2024, 4, 14), end_date=date(2024, 5, 22))
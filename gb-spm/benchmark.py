@@ -0,0 +1,124 @@
+import time
+import numpy as np
+from datetime import datetime
+from position_fix_utils import position_fix_dtype, distance_between_points, distance_between_arrays, smooth_trajectory
+from gb_spm import (
+    characteristic_indices,
+    characteristic_point_potentials,
+    neighborhood_stay_times,
+    cp_weight_matrix,
+)
+
+
+# Random walk at 1 Hz that alternates between stops and moves, used when no device data is at hand
+def synthetic_trajectory(n, seed=0):
+    rng = np.random.default_rng(seed)
+    moving = (np.arange(n) // 600) % 2 == 1
+    step = np.where(moving, 1.5e-5, 1e-7)[:, np.newaxis] * rng.normal(size=(n, 2))
+    trajectory = np.zeros(n, dtype=position_fix_dtype)
+    trajectory['lat'] = 40.0 + np.cumsum(step[:, 0])
+    trajectory['lon'] = -75.0 + np.cumsum(step[:, 1])
+    trajectory['time'] = 1.7e9 + np.arange(n, dtype=np.float64)
+    trajectory['accuracy'] = rng.uniform(3, 60, n)
+    trajectory['speed'] = np.where(moving, 1.5, 0.0)
+    return trajectory
+
+
+# Synthetic trajectory with every fix moved by normal noise of its accuracy in meters. Returns (noisy, truth).
+def noisy_trajectory(n, seed=0):
+    truth = synthetic_trajectory(n, seed)
+    rng = np.random.default_rng(seed + 1)
+    noisy = truth.copy()
+    meters_per_degree = 111320.0
+    noisy['lat'] += rng.normal(size=n) * truth['accuracy'] / meters_per_degree
+    noisy['lon'] += rng.normal(size=n) * truth['accuracy'] / (meters_per_degree * np.cos(np.radians(truth['lat'])))
+    return noisy, truth
+
+
+# Keyword arguments of smooth_trajectory for each method compared, with the smoothing factor of main.gb_spm
+def smoothing_methods(n):
+    return {
+        'spline': dict(method='spline', s=5e-11 * n, weight='inverse'),
+        'windowed_spline': dict(method='windowed_spline', s=5e-11 * n, weight='inverse'),
+        'savgol': dict(method='savgol', weight='square'),
+        'kalman': dict(method='kalman'),
+    }
+
+
+def rms_meters(points1, points2):
+    return np.sqrt(np.mean(distance_between_arrays(points1, points2, unit='m') ** 2))
+
+
+# Time of each smoothing method and its RMS error in meters from the noise free synthetic trajectory
+def smoothing_benchmark(sizes=(1000, 10000, 86400)):
+    print(f"{'points':>8} {'method':>16} {'time (s)':>9} {'rms to truth (m)':>17}")
+    for n in sizes:
+        noisy, truth = noisy_trajectory(n)
+        print(f"{n:>8} {'raw':>16} {0:>9.3f} {rms_meters(noisy, truth):>17.2f}")
+        for name, arguments in smoothing_methods(n).items():
+            elapsed, smoothed = time_call(lambda: smooth_trajectory(noisy, **arguments), repeat=1)
+            print(f"{n:>8} {name:>16} {elapsed:>9.3f} {rms_meters(smoothed, truth):>17.2f}")
+
+
+# Time of each smoothing method on days of device data and its RMS difference in meters from the global spline
+def smoothing_comparison(dates=((2024, 4, 19), (2024, 4, 20), (2024, 5, 22))):
+    from utils import absolute_path
+    from TrajectoryStore import open_store
+    days = open_store(absolute_path("../data/andrew-device-locations-all.csv"), accuracy_threshold=80).days()
+
+    print(f"{'day':>10} {'points':>7} {'method':>16} {'time (s)':>9} {'rms to spline (m)':>18}")
+    for date in dates:
+        day = days.day(datetime(*date))
+        if len(day) < 4:
+            continue
+        methods = smoothing_methods(len(day))
+        spline = smooth_trajectory(day, **methods.pop('spline'))
+        for name, arguments in methods.items():
+            elapsed, smoothed = time_call(lambda: smooth_trajectory(day, **arguments), repeat=1)
+            print(f"{datetime(*date):%Y-%m-%d} {len(day):>7} {name:>16} {elapsed:>9.3f} "
+                  f"{rms_meters(smoothed, spline):>18.2f}")
+
+
+# Weight matrix as computed before it was vectorized, kept as a reference for correctness and speed
+def weight_matrix_loop(trajectory, cp_indices, stay_times, characteristic_potentials, r_index, dist_mult):
+    weight_matrix = np.zeros((len(cp_indices), r_index))
+    for i in range(len(cp_indices) - 1):
+        for j in range(r_index - max(i + 1 - len(cp_indices) + r_index, 0)):
+            mutual_stay_time = np.average([stay_times[i], stay_times[i + j + 1]])
+            relative_potential = abs(characteristic_potentials[i] - characteristic_potentials[i + j + 1])
+            points = np.array([trajectory[cp_indices[i]], trajectory[cp_indices[i + j + 1]]])
+            dist = distance_between_points(points)[0] * dist_mult
+            weight_matrix[i][j] = mutual_stay_time * relative_potential * np.exp(-dist)
+    return weight_matrix
+
+
+# Best wall time of repeat calls and the result of the last one
+def time_call(function, *args, repeat=3):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def weight_matrix_benchmark(sizes=(1000, 10000, 86400), r_index=3, dist_mult=60):
+    print(f"{'points':>8} {'CPs':>8} {'loop (s)':>10} {'banded (s)':>11} {'speedup':>8} identical")
+    for n in sizes:
+        trajectory = synthetic_trajectory(n)
+        cp_indices = characteristic_indices(trajectory, 4, 1)
+        potentials = characteristic_point_potentials(trajectory, cp_indices, r_index, dist_mult)
+        stay_times = neighborhood_stay_times(trajectory[cp_indices], r_index)
+        args = (trajectory, cp_indices, stay_times, potentials, r_index, dist_mult)
+
+        loop_time, expected = time_call(weight_matrix_loop, *args, repeat=1)
+        banded_time, result = time_call(cp_weight_matrix, *args)
+        print(f"{n:>8} {len(cp_indices):>8} {loop_time:>10.3f} {banded_time:>11.4f} "
+              f"{loop_time / banded_time:>8.0f} {np.array_equal(expected, result)}")
+
+
+if __name__ == '__main__':
+    weight_matrix_benchmark()
+    smoothing_benchmark()
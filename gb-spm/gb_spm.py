@@ -1,235 +1,342 @@
 import numpy as np
-from position_fix_utils import distance_between_points
-from StopRegion import StopRegion
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from position_fix_utils import distance_between_points, distance_between_arrays, smooth_trajectory
+from TrajectoryContext import TrajectoryContext
+import common_path  # noqa: F401
+from GridIndex import merge_groups
+from hull import hull_vertices, hull_shape
+from StopRegionSet import StopRegionSet
+from silhouette import region_silhouettes
+
+
+# Smoothing factor per point for each weight, as tuned on the labeled days
+def smoothing_factor(weight, r_index=1):
+    if weight == 'inverse':
+        return 5e-11
+    elif weight == 'square':
+        return 5e-13
+    elif weight == 'neighbor':
+        return 5e-11 / (2 * r_index + 1)
+    else:
+        raise ValueError('Weight must be inverse, square, or neighbor')
+
+
+# Runs the whole pipeline on one trajectory: smoothing, characteristic points and significant place mining
+def detect_stop_regions(trajectory, weight='inverse', smoothing_r_index=1, cp_r_index=4, max_velocity=1, r_index=3,
+                        max_dist=0.25, max_time=120, dist_mult=60, return_smoothed=False):
+    s = smoothing_factor(weight, smoothing_r_index)
+    smoothed = smooth_trajectory(trajectory, s=s * len(trajectory), weight=weight, r_index=smoothing_r_index)
+
+    # Distances and stay times of the smoothed points, shared by all stages
+    context = TrajectoryContext(smoothed)
+    cp_indices = characteristic_indices(smoothed, cp_r_index, max_velocity, context=context)
+    stop_regions = significant_place_mining(smoothed, cp_indices, r_index, max_dist, max_time, dist_mult,
+                                            context=context)
+    if return_smoothed:
+        return stop_regions, smoothed
+    return stop_regions
 
 
 # Returns significant places
-def significant_place_mining(trajectory, cp_indices, r_index, max_dist, max_time, dist_mult, unit='sec'):
-    vertex_labels = np.arange(len(cp_indices))
-    characteristic_potentials = characteristic_point_potentials(trajectory, cp_indices, r_index, dist_mult)
-    stay_times = neighborhood_stay_times(trajectory[cp_indices], r_index, unit=unit)
-
-    # Define weight matrix
-    # Only need weights between CPs and their following CPs since the weight of a preceding CP is the same
-    # as in the preceding point's following CP
-    weight_matrix = np.zeros((len(cp_indices), r_index))
-    for i in range(len(cp_indices) - 1):
-        for j in range(r_index - max(i + 1 - len(cp_indices) + r_index, 0)):
-            mutual_stay_time = np.average([stay_times[i], stay_times[i + j + 1]])
-            relative_potential = abs(characteristic_potentials[i] - characteristic_potentials[i + j + 1])
-            points = np.array([trajectory[cp_indices[i]], trajectory[cp_indices[i+j+1]]])
-            dist = distance_between_points(points) * dist_mult
-            weight_matrix[i][j] = mutual_stay_time * relative_potential * np.exp(-dist)
-
-    # Find max weight for each vertex and create an array recording their indices
-    max_weight_indices = np.zeros(len(cp_indices)).astype(np.int32)
-    for i in range(len(cp_indices)):
-        # Find neighborhood weights for vertex i
-        earlier_neighbor_weights = np.diagonal(np.fliplr(weight_matrix), offset=r_index - i)
-        later_neighbor_weights = weight_matrix[i][:len(cp_indices) - i - 1]
-        neighbor_weights = np.concatenate([earlier_neighbor_weights, later_neighbor_weights])
-
-        # Update label of i to that of the max weight vertex
-        max_idx = np.argmax(neighbor_weights)
-        if max_idx < len(earlier_neighbor_weights):
-            max_label_offset = max_idx - len(earlier_neighbor_weights)
-        else:
-            max_label_offset = max_idx - len(earlier_neighbor_weights) + 1
-        max_weight_indices[i] = i + max_label_offset
-
-        # Set its child to itself if max_distance and max_time are exceeded
-        if (distance_between_points(trajectory[cp_indices[[i, max_weight_indices[i]]]]) > max_dist and
-                abs(np.diff(trajectory[cp_indices[[i, max_weight_indices[i]]]]['time'])) > max_time):
-            max_weight_indices[i] = i
+# Derived quantities come from context, which is created if not given and can be shared with characteristic_indices
+def significant_place_mining(trajectory, cp_indices, r_index, max_dist, max_time, dist_mult, unit='sec', context=None):
+    max_weight_indices, band_distances = max_weight_graph(trajectory, cp_indices, r_index, dist_mult, unit, context)
+    max_weight_indices = cut_distant_parents(trajectory, cp_indices, max_weight_indices, band_distances, max_dist,
+                                             max_time)
 
     # Update labels
-    order = np.argsort(-characteristic_potentials)
-    max_iterations = 15
-    for it in range(max_iterations):
-        changed = False
-        for i in order:
-            if vertex_labels[i] != vertex_labels[max_weight_indices[i]]:
-                changed = True
-                vertex_labels[i] = vertex_labels[max_weight_indices[i]]
-        if not changed:
-            break
+    vertex_labels = propagate_labels(max_weight_indices)
 
     stop_regions = generate_stop_regions(trajectory, cp_indices, vertex_labels)
 
     return stop_regions
 
 
+# Returns the max weight neighbor of each CP and the band distances between the CPs.
+# Neither depends on max_dist or max_time, so they can be shared by runs that only change those.
+def max_weight_graph(trajectory, cp_indices, r_index, dist_mult, unit='sec', context=None):
+    if context is None:
+        context = TrajectoryContext(trajectory)
+    cp_context = context.subset(cp_indices)
+    characteristic_potentials = characteristic_point_potentials(trajectory, cp_indices, r_index, dist_mult,
+                                                                context.distances())
+    stay_times = cp_context.stay_times(r_index, unit=unit)
+    band_distances = cp_context.band_distances(r_index)
+
+    weight_matrix = cp_weight_matrix(trajectory, cp_indices, stay_times, characteristic_potentials, r_index, dist_mult,
+                                     band_distances)
+
+    # Find max weight for each vertex and create an array recording their indices
+    return max_weight_neighbors(weight_matrix), band_distances
+
+
+# Returns a copy of max_weight_indices where every vertex whose max weight neighbor exceeds both max_dist and max_time
+# is its own parent
+# Parents are within r_index CPs, so their distance is in the band of the earlier of the two
+def cut_distant_parents(trajectory, cp_indices, max_weight_indices, band_distances, max_dist, max_time):
+    max_weight_indices = max_weight_indices.copy()
+    vertices = np.arange(len(cp_indices))
+    offsets = max_weight_indices - vertices
+    parent_distances = np.zeros(len(cp_indices))
+    has_parent = offsets != 0
+    parent_distances[has_parent] = band_distances[np.minimum(vertices, max_weight_indices)[has_parent],
+                                                  np.abs(offsets[has_parent]) - 1]
+    times = trajectory['time'][cp_indices]
+    exceeded = (parent_distances > max_dist) & (np.abs(times[max_weight_indices] - times) > max_time)
+    max_weight_indices[exceeded] = vertices[exceeded]
+    return max_weight_indices
+
+
+# Mean of the silhouettes of the stop regions, or None if there are fewer than two
+def mean_silhouette(stop_regions):
+    if len(stop_regions) <= 1:
+        return None
+    return float(np.mean(region_silhouettes(stop_regions)))
+
+
+# Define weight matrix
+# Only need weights between CPs and their following CPs since the weight of a preceding CP is the same
+# as in the preceding point's following CP. Column k - 1 holds the weights to the CPs k places later, so the matrix
+# is filled one band (offset) at a time.
+# band_distances are the km distances between the CPs as given by TrajectoryContext.band_distances.
+def cp_weight_matrix(trajectory, cp_indices, stay_times, characteristic_potentials, r_index, dist_mult,
+                     band_distances=None):
+    weight_matrix = np.zeros((len(cp_indices), r_index))
+    characteristic_points = trajectory[cp_indices]
+    for k in range(1, min(r_index, len(cp_indices) - 1) + 1):
+        mutual_stay_time = (stay_times[:-k] + stay_times[k:]) / 2
+        relative_potential = np.abs(characteristic_potentials[:-k] - characteristic_potentials[k:])
+        if band_distances is None:
+            dist = distance_between_arrays(characteristic_points[k:], characteristic_points[:-k]) * dist_mult
+        else:
+            dist = band_distances[:-k, k - 1] * dist_mult
+        weight_matrix[:-k, k - 1] = mutual_stay_time * relative_potential * np.exp(-dist)
+    return weight_matrix
+
+
+# Returns the index of the max weight neighbor of each vertex, or the vertex itself if it has no neighbors.
+# Columns of the band are the earlier neighbors from farthest to nearest followed by the later neighbors from nearest to
+# farthest, so argmax breaks ties in the same order as when neighbors were concatenated per vertex.
+def max_weight_neighbors(weight_matrix):
+    n, r_index = weight_matrix.shape
+    vertices = np.arange(n)
+    offsets = np.concatenate([np.arange(-r_index, 0), np.arange(1, r_index + 1)])
+    neighbors = vertices[:, np.newaxis] + offsets
+    valid = (neighbors >= 0) & (neighbors < n)
+
+    # The weight to an earlier neighbor at offset k is stored in that neighbor's row
+    rows = np.minimum(neighbors, vertices[:, np.newaxis])
+    columns = np.broadcast_to(np.abs(offsets) - 1, neighbors.shape)
+    band = np.full(neighbors.shape, -np.inf)
+    band[valid] = weight_matrix[rows[valid], columns[valid]]
+
+    max_weight_indices = neighbors[vertices, np.argmax(band, axis=1)]
+    isolated = ~valid.any(axis=1)
+    max_weight_indices[isolated] = vertices[isolated]
+    return max_weight_indices
+
+
+# Every vertex takes the label of its max weight vertex until nothing changes, which leaves one label per connected
+# component of the max weight graph. The components are found directly instead of iterating.
+# Labels are numbered in order of the earliest vertex of each component.
+def propagate_labels(max_weight_indices):
+    n = len(max_weight_indices)
+    graph = coo_matrix((np.ones(n), (np.arange(n), max_weight_indices)), shape=(n, n))
+    _, vertex_labels = connected_components(graph, directed=False)
+    return vertex_labels
+
+
 # Returns indices of characteristic points (points where neighborhood_velocity <= max_velocity)
-def characteristic_indices(trajectory, r_index, max_velocity, unit='kph'):
-    velocities = neighborhood_velocities(trajectory, r_index, unit=unit)
+def characteristic_indices(trajectory, r_index, max_velocity, unit='kph', context=None):
+    velocities = neighborhood_velocities(trajectory, r_index, unit=unit, context=context)
     cp_indices = np.where(velocities <= max_velocity)[0]
     return cp_indices
 
 
 # Returns total distance traveled over time
-def neighborhood_velocities(trajectory, r_index, unit):
+def neighborhood_velocities(trajectory, r_index, unit, context=None):
     if unit == 'kph':
         dist_unit, time_unit = 'km', 'hr'
     elif unit == 'mps':
         dist_unit, time_unit = 'm', 'sec'
     else:
         raise ValueError('Unit must be kph or mps')
+    if context is None:
+        context = TrajectoryContext(trajectory)
 
     # Get sum of distances in neighborhood for each point
-    distances = distance_between_points(trajectory, unit=dist_unit)
+    distances = context.distances()
+    if dist_unit == 'm':
+        distances = distances * 1000
     padded_dist = np.pad(distances, (r_index, r_index), mode='constant', constant_values=0)
     dist_kernel = np.ones(2 * r_index)
     distance_sums = np.convolve(padded_dist, dist_kernel, mode='valid')
 
-    times = neighborhood_stay_times(trajectory, r_index, unit=time_unit)
+    times = context.stay_times(r_index, unit=time_unit)
 
     return distance_sums / times
 
 
 # Returns total time of each neighborhood
 def neighborhood_stay_times(trajectory, r_index, unit='sec'):
-    times = trajectory['time']
-    padded_time = np.pad(times, (r_index, r_index), mode='edge')
-    time_kernel = np.zeros(2 * r_index + 1)
-    time_kernel[0] = 1
-    time_kernel[-1] = -1
-    time_diffs = np.convolve(padded_time, time_kernel, mode='valid')
-    if unit == 'sec':
-        return time_diffs
-    elif unit == 'min':
-        return time_diffs / 60
-    elif unit == 'hr':
-        return time_diffs / 3600
-    else:
-        raise ValueError('Unit must be sec, min, or hr.')
+    return TrajectoryContext(trajectory).stay_times(r_index, unit=unit)
 
 
 # Returns characteristic point potentials of each characteristic point
-def characteristic_point_potentials(trajectory, cp_indices, r_index, dist_mult):
-    potentials = []
-    distances = distance_between_points(trajectory) * dist_mult
+# exp(-d / std) is computed once for the whole trajectory and every neighborhood sum is the difference of two entries of
+# its cumulative sum. distances are the km distances between consecutive points and are computed if not given.
+def characteristic_point_potentials(trajectory, cp_indices, r_index, dist_mult, distances=None):
+    if distances is None:
+        distances = distance_between_points(trajectory)
+    distances = distances * dist_mult
     std_dev = np.std(distances)
-    for i in range(len(cp_indices)):
-        before_in_neighborhood = np.min([r_index, i])
-        after_in_neighborhood = np.min([r_index, len(cp_indices) - i + 1])
-        start = cp_indices[i] - before_in_neighborhood
-        end = cp_indices[i] + after_in_neighborhood
+    cumulative_potentials = np.concatenate([[0.0], np.cumsum(np.exp(-distances / std_dev))])
 
-        potential = np.sum(np.exp(-distances[start:end] / std_dev))
+    ordinals = np.arange(len(cp_indices))
+    before_in_neighborhood = np.minimum(r_index, ordinals)
+    after_in_neighborhood = np.minimum(r_index, len(cp_indices) - ordinals + 1)
+    start = cp_indices - before_in_neighborhood
+    end = np.minimum(cp_indices + after_in_neighborhood, len(distances))
 
-        potentials.append(potential)
-    return np.array(potentials)
+    return cumulative_potentials[end] - cumulative_potentials[start]
 
 
 def generate_stop_regions(trajectory, cp_indices,  vertex_labels):
-    unique_labels = np.unique(vertex_labels)
-    stop_regions = []
-    for label in unique_labels:
-        points = trajectory[cp_indices[vertex_labels == label]]
-        stop_regions.append(StopRegion(points))
+    # Stays are merged and filtered on the columnar set
+    merged = StopRegionSet.from_labels(trajectory[cp_indices], vertex_labels)
 
-    merged = recursive_merge(stop_regions, 50)
+    merged = recursive_merge(merged, 50)
 
     # merged = merge_short_stops(merged, 300, 120)
 
     merged = merge_stops_in_regions(merged, trajectory, cp_indices, 3, 300)
 
     # Remove all stops below 5 minutes
-    for i in range(len(merged) - 1, -1, -1):
-        if merged[i].exit_times[-1] - merged[i].entry_times[0] <= 300:
-            merged.pop(i)
+    merged = merged.filter(merged.durations() > 300)
 
-    return merged
+    return merged.to_stop_regions()
 
 
-def recursive_merge(multi_points, threshold):
-    merged = merge_stop_regions(multi_points, threshold)
-    if len(merged) == len(multi_points):
-        return multi_points
-    else:
-        return recursive_merge(merged, threshold)
+def recursive_merge(stops, threshold):
+    return merge_stop_regions(stops, threshold)
 
 
 # Function to merge point clouds based if they overlap at all or if centroids are close
-def merge_stop_regions(stop_regions, distance_threshold):
-    merged_stops = [stop_regions[0]]
-    for stop in stop_regions[1:]:
-        merged = False
-        min_distance = None
-        min_distance_index = None
-        for i in range(len(merged_stops)):
-            if stop.intersects(merged_stops[i]):
-                merged_stops[i] = merged_stops[i].union(stop)
-                merged = True
-                break
-            distance = stop.centroid_distance(merged_stops[i])
-            if min_distance is None or distance < min_distance:
-                min_distance = distance
-                min_distance_index = i
-        # If no intersections, merge with the closest region if under distance_threshold
-        if min_distance is not None and min_distance < distance_threshold:
-            merged_stops[min_distance_index] = merged_stops[min_distance_index].union(stop)
-            merged = True
-
-        # Make a new region if not merged
-        if not merged:
-            merged_stops.append(stop)
-    return merged_stops
-
-
-def merge_short_stops(stops, duration_threshold, merge_threshold):
-    entry_times = []
-    exit_times = []
-    stop_indices = []
-    for i in range(len(stops)):
-        entry_times.extend(stops[i].entry_times)
-        exit_times.extend(stops[i].exit_times)
-        stop_indices.extend([i] * len(stops[i].entry_times))
-    entry_times = np.array(entry_times)
-    exit_times = np.array(exit_times)
-    stop_indices = np.array(stop_indices)
-
-    merged = []
+# Overlapping regions are merged first, then the closest region under distance_threshold
+# Takes and returns a StopRegionSet. While merging, each region only keeps its hull vertices, the sum and count of its
+# coordinates for the centroid and its bounding box, which are updated in place when it absorbs another region. The
+# points and visits are regrouped once at the end.
+def merge_stop_regions(stops, distance_threshold):
+    counts = np.diff(stops.point_offsets).astype(np.float64)
+    coordinate_sums = stops.centroids * counts[:, np.newaxis]
+    bboxes = stops.bboxes.copy()
+    hulls = []
     for i in range(len(stops)):
-        if len(stops[i].entry_times) == 1:
-            after_times = entry_times - stops[i].exit_times[0]
-            before_times = stops[i].entry_times[0] - exit_times
-            after_positive = after_times[after_times > 0]
-            before_positive = before_times[before_times > 0]
-
-            # do not merge if there is no stop within merge_threshold_time of the current stop
-            if np.min(np.concatenate([after_positive, before_positive])) > merge_threshold:
-                merged.append(stops[i])
-                continue
-
-            if len(after_positive) == 0:
-                merge_into = stop_indices[before_times > 0][np.argmin(before_positive)]
-            elif len(before_positive) == 0:
-                merge_into = stop_indices[after_times > 0][np.argmin(after_positive)]
-            elif min(before_positive) <= min(after_positive):
-                merge_into = stop_indices[before_times > 0][np.argmin(before_positive)]
-            else:
-                merge_into = stop_indices[after_times > 0][np.argmin(after_positive)]
-
-            # Merge only times. These stops are usually due to people slowly entering or leaving a location and
-            # therefore would add outliers to the plotted location
-            stops[merge_into].entry_times.append(stops[i].entry_times[0])
-            stops[merge_into].exit_times.append(stops[i].exit_times[0])
+        points = stops.region_points(i)
+        hulls.append(hull_vertices(np.column_stack([points['lon'], points['lat']])))
+    shapes = [hull_shape(hull) for hull in hulls]
+
+    def merge_key(later, earlier):
+        if shapes[later].intersects(shapes[earlier]):
+            return 0.0
+        centroids = coordinate_sums[[later, earlier]] / counts[[later, earlier], np.newaxis]
+        distance = distance_between_arrays({'lon': centroids[:1, 0], 'lat': centroids[:1, 1]},
+                                           {'lon': centroids[1:, 0], 'lat': centroids[1:, 1]}, unit='m')[0]
+        return distance if distance < distance_threshold else None
+
+    def union(earlier, later):
+        counts[earlier] += counts[later]
+        coordinate_sums[earlier] += coordinate_sums[later]
+        bboxes[earlier, :2] = np.minimum(bboxes[earlier, :2], bboxes[later, :2])
+        bboxes[earlier, 2:] = np.maximum(bboxes[earlier, 2:], bboxes[later, 2:])
+        hulls[earlier] = hull_vertices(np.concatenate([hulls[earlier], hulls[later]]))
+        shapes[earlier] = hull_shape(hulls[earlier])
+        return tuple(bboxes[earlier])
+
+    return stops.merge(merge_groups([tuple(bbox) for bbox in bboxes], merge_key, union, distance_threshold))
+
+
+# Stops with a single visit within merge_threshold seconds of a visit of another stop give their visit to the stop of
+# the closest visit before or after them. Takes and returns a StopRegionSet.
+# The closest visits are found by binary search in the visit timeline. A stop that an earlier stop gives its visit to
+# keeps its own, and a visit given to a stop that has itself been given away goes to the stop that stop went to.
+def merge_short_stops(stops, duration_threshold, merge_threshold):
+    visit_count = len(stops.entry_times)
+    if visit_count == 0:
+        return stops
+    visit_region = stops.visit_region
+    entry_order, exit_order = stops.timeline()
+    sorted_entries = stops.entry_times[entry_order]
+    sorted_exits = stops.exit_times[exit_order]
+
+    singles = np.nonzero(np.diff(stops.visit_offsets) == 1)[0]
+    visits = stops.visit_offsets[singles]
+    entries = stops.entry_times[visits]
+    exits = stops.exit_times[visits]
+
+    # First visit entering after the exit and last visit exiting before the entry. Of visits with the same time, the
+    # one of the earliest stop is used.
+    after = np.searchsorted(sorted_entries, exits, side='right')
+    before = np.searchsorted(sorted_exits, entries, side='left') - 1
+    after_times = np.where(after < visit_count, sorted_entries[np.minimum(after, visit_count - 1)] - exits, np.inf)
+    before_times = np.where(before >= 0, entries - sorted_exits[np.maximum(before, 0)], np.inf)
+    before = np.searchsorted(sorted_exits, sorted_exits[np.maximum(before, 0)], side='left')
+
+    # Merge only times. These stops are usually due to people slowly entering or leaving a location and
+    # therefore would add outliers to the plotted location
+    merge_before = before_times <= after_times
+    targets = np.where(merge_before, visit_region[exit_order[before]],
+                       visit_region[entry_order[np.minimum(after, visit_count - 1)]])
+    close = np.minimum(before_times, after_times) <= merge_threshold
+
+    # Stops are handled in order as in the loop over stops: a close single visit stop is absorbed unless an earlier stop
+    # that was absorbed gave it its visit, which makes it a stop with two visits. Each candidate only depends on earlier
+    # ones, so iterating from all absorbed settles one more step of every chain per pass until nothing changes.
+    # An absorbed stop only targets absorbed stops before it, so the chains have no cycles and pointer jumping resolves
+    # every stop to the stop its visit ends up in.
+    candidates = singles[close]
+    targets = targets[close]
+    positions = np.minimum(np.searchsorted(candidates, targets), max(len(candidates) - 1, 0))
+    gives_to_later = (targets > candidates) & (candidates[positions] == targets)
+    sources = np.nonzero(gives_to_later)[0]
+    receivers = positions[sources]
+    absorbed = np.ones(len(candidates), dtype=bool)
+    while True:
+        received = np.zeros(len(candidates), dtype=bool)
+        received[receivers[absorbed[sources]]] = True
+        if np.array_equal(absorbed, ~received):
+            break
+        absorbed = ~received
 
-        else:
-            merged.append(stops[i])
-    return merged
+    absorbed_into = np.arange(len(stops))
+    absorbed_into[candidates[absorbed]] = targets[absorbed]
+    while True:
+        jumped = absorbed_into[absorbed_into]
+        if np.array_equal(jumped, absorbed_into):
+            break
+        absorbed_into = jumped
+
+    # Received visits follow the stop's own visits in the order they were given
+    moved = visits[close][absorbed]
+    new_regions = visit_region.copy()
+    new_regions[moved] = absorbed_into[candidates[absorbed]]
+    keys = np.arange(visit_count)
+    keys[moved] = visit_count + np.arange(len(moved))
+    merged = stops.assign_visits(new_regions, keys)
+    return merged.filter(absorbed_into == np.arange(len(stops)))
 
 
-# Merge all stops within index_threshold characteristic points or time_threshold seconds of each other
+# Merge all stays of a stop within index_threshold characteristic points or time_threshold seconds of each other
+# Takes and returns a StopRegionSet. The stays of each stop are put in time order first, so each stay is compared with
+# the one that follows it in time.
 # TODO: make this just be merge 2 stops if there is no stop in between them
 def merge_stops_in_regions(stops, trajectory, cp_indices, index_threshold, time_threshold):
+    stops = stops.sort_visits()
     times = trajectory[cp_indices]['time']
-    for i in range(len(stops)):
-        entry_indices = np.searchsorted(times, stops[i].entry_times)
-        exit_indices = np.searchsorted(times, stops[i].exit_times)
-        # places where the exit and following entry are within index_threshold characteristic points
-        exit_indices_to_remove = np.where(entry_indices[1:] - exit_indices[:-1] <= index_threshold)[0]
-        stops[i].entry_times = np.delete(stops[i].entry_times, exit_indices_to_remove + 1)
-        stops[i].exit_times = np.delete(stops[i].exit_times, exit_indices_to_remove)
-    return stops
+    entry_indices = np.searchsorted(times, stops.entry_times)
+    exit_indices = np.searchsorted(times, stops.exit_times)
+    # places where the exit and following entry are within index_threshold characteristic points
+    joins_next = np.zeros(len(entry_indices), dtype=bool)
+    joins_next[:-1] = entry_indices[1:] - exit_indices[:-1] <= index_threshold
+    return stops.join_visits(joins_next)
@@ -1,16 +1,18 @@
 from utils import absolute_path
-from position_fix_utils import position_fix_from_csv, filter_by_date, smooth_trajectory
+from position_fix_utils import smooth_trajectory
+from TrajectoryContext import TrajectoryContext
+from TrajectoryStore import open_store
 from MapPlot import MapPlot
 import webbrowser
 from datetime import datetime
-from gb_spm import characteristic_indices, significant_place_mining
+from gb_spm import characteristic_indices, significant_place_mining, detect_stop_regions, mean_silhouette
 import numpy as np
 
 
 def silhouette_comparison():
     # Get trajectory
     data_path = absolute_path("../data/andrew-device-locations-all.csv")
-    location_data = position_fix_from_csv(data_path, accuracy_threshold=80)
+    days = open_store(data_path, accuracy_threshold=80).days()
 
     means = []
     test_values = [1e-11, 1e-12, 1e-13, 1e-14, 1e-15]
@@ -21,7 +23,7 @@ def silhouette_comparison():
             month = 4 + int(i / 31)
             day = i % 30 + 1
             day = datetime(2024, month, day)
-            day_trajectory = filter_by_date(location_data, day)
+            day_trajectory = days.day(day)
             if len(day_trajectory) < 4:
                 continue
             s = get_silhouette(day_trajectory, weight='inverse', s=test * len(day_trajectory), r_index=1)
@@ -35,37 +37,16 @@ def silhouette_comparison():
 
 def get_silhouette(trajectory, weight='uniform', s=5e-11, r_index=None):
     smoothed = smooth_trajectory(trajectory, s=s * len(trajectory), weight=weight, r_index=r_index)
-    cp_indices = characteristic_indices(smoothed, 4, 1)  # [45:47]
-    significant_places = significant_place_mining(smoothed, cp_indices, 3, 0.25, 120, 60)
-    if len(significant_places) <= 1:
-        return None
-
-    s = 0
-    for i in range(len(significant_places)):
-        s += significant_places[i].silhouette(significant_places[:i] + significant_places[i + 1:])
-    s /= len(significant_places)
-    return s
+    context = TrajectoryContext(smoothed)
+    cp_indices = characteristic_indices(smoothed, 4, 1, context=context)  # [45:47]
+    significant_places = significant_place_mining(smoothed, cp_indices, 3, 0.25, 120, 60, context=context)
+    return mean_silhouette(significant_places)
 
 
 def gb_spm(trajectory, weight):
-    # Smoothing
-    r_index = 1
-    if weight == 'inverse':
-        s = 5e-11
-    elif weight == 'square':
-        s = 5e-13
-    elif weight == 'neighbor':
-        s = 5e-11 / (2 * r_index + 1)
-    smoothed = smooth_trajectory(trajectory, s=s * len(trajectory), weight=weight, r_index=r_index)
+    significant_places, smoothed = detect_stop_regions(trajectory, weight=weight, return_smoothed=True)
     # smoothed = smooth_trajectory(trajectory, s=5e-14 * len(trajectory), weight="square")
 
-    # Characteristic points
-    cp_indices = characteristic_indices(smoothed, 4, 1)  # [45:47]
-    characteristic_points = trajectory[cp_indices]
-
-    # Significant places
-    significant_places = significant_place_mining(smoothed, cp_indices, 3, 0.25, 120, 60)
-
     map_plot = MapPlot()
     map_plot.add_curve(smoothed, color='yellow')
     map_plot.add_curve(trajectory, color='#4e108d')
@@ -80,21 +61,21 @@ def gb_spm(trajectory, weight):
 
 def all_data():
     data_path = absolute_path("../data/andrew-device-locations-all.csv")
-    location_data = position_fix_from_csv(data_path, accuracy_threshold=120)
-    gb_spm(location_data)
+    location_data = open_store(data_path, accuracy_threshold=120)
+    gb_spm(location_data.points, weight='inverse')
 
 
 def day_by_day():
     # Get trajectory
     data_path = absolute_path("../data/andrew-device-locations-all.csv")
-    location_data = position_fix_from_csv(data_path, accuracy_threshold=80)
+    days = open_store(data_path, accuracy_threshold=80).days()
 
     # Filter to one day
     for i in range(14, 52):
         month = 4 + int(i / 31)
         day = i % 30 + 1
         day = datetime(2024, month, day)
-        day_trajectory = filter_by_date(location_data, day)
+        day_trajectory = days.day(day)
         if len(day_trajectory) < 4:
             continue
         gb_spm(day_trajectory, weight='inverse')
@@ -105,11 +86,11 @@ def day_by_day():
 def given_day(month, day):
     # Get trajectory
     data_path = absolute_path("../data/andrew-device-locations-all.csv")
-    location_data = position_fix_from_csv(data_path, accuracy_threshold=80)
+    location_data = open_store(data_path, accuracy_threshold=80)
 
     # Filter to one day
     day = datetime(2024, month, day)
-    day_trajectory = filter_by_date(location_data, day)
+    day_trajectory = location_data.day(day)
     gb_spm(day_trajectory, weight="inverse")
 
 
@@ -1,7 +1,10 @@
 import numpy as np
 import csv
+from itertools import islice
 from datetime import datetime
 from scipy.interpolate import UnivariateSpline
+import common_path  # noqa: F401
+from dates import day_bounds, DayPartition
 
 
 position_fix_dtype = np.dtype([('lat', np.float64),
@@ -11,24 +14,53 @@ position_fix_dtype = np.dtype([('lat', np.float64),
                                ('speed', np.float64)])
 
 
-def position_fix_from_csv(file_path, remove_duplicates=True, accuracy_threshold=None):
-    data = []
+# Csv column names of position_fix_dtype fields that are not named the same in the csv
+csv_columns = {'lat': 'latitude', 'lon': 'longitude', 'time': 'create_time_epoch'}
+
+
+def position_fix_from_csv(file_path, remove_duplicates=True, accuracy_threshold=None, dtype=position_fix_dtype):
+    chunks = list(position_fix_chunks(file_path, remove_duplicates, accuracy_threshold, dtype=dtype))
+    if len(chunks) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(chunks)
+
+
+# Yields the fixes of a csv as structured arrays of at most chunk_size rows so memory stays bounded.
+# Only the columns in dtype are parsed. Duplicates are consecutive identical rows, which are compared before the
+# accuracy filter is applied, including across chunk boundaries.
+def position_fix_chunks(file_path, remove_duplicates=True, accuracy_threshold=None, chunk_size=100000,
+                        dtype=position_fix_dtype):
     with open(file_path, 'r') as file:
-        reader = csv.DictReader(file)
+        header = next(csv.reader([file.readline()]))
+        columns = [csv_columns.get(name, name) for name in dtype.names]
+        missing = [column for column in columns if column not in header]
+        if len(missing) > 0:
+            raise ValueError(f"Missing csv columns: {missing}")
+        usecols = [header.index(column) for column in columns]
+
         prior = None
-        for row in reader:
-            point = (float(row['latitude']), float(row['longitude']), float(row['create_time_epoch']), float(row['accuracy']), float(row['speed']))
+        while True:
+            lines = list(islice(file, chunk_size))
+            if len(lines) == 0:
+                break
+            values = np.loadtxt(lines, dtype=np.float64, delimiter=',', quotechar='"', usecols=usecols, ndmin=2)
+            if len(values) == 0:
+                continue
+
+            keep = np.ones(len(values), dtype=bool)
             if remove_duplicates:
-                if prior is not None and prior == point:
-                    prior = point
-                    continue
-                else:
-                    prior = point
+                keep[1:] = np.any(values[1:] != values[:-1], axis=1)
+                if prior is not None:
+                    keep[0] = np.any(values[0] != prior)
+                prior = values[-1]
             if accuracy_threshold is not None:
-                if float(row['accuracy']) > accuracy_threshold:
-                    continue
-            data.append(point)
-    return np.array(data, dtype=position_fix_dtype)
+                keep &= ~(values[:, dtype.names.index('accuracy')] > accuracy_threshold)
+            values = values[keep]
+
+            chunk = np.zeros(len(values), dtype=dtype)
+            for i, name in enumerate(dtype.names):
+                chunk[name] = values[:, i]
+            yield chunk
 
 
 def distance_between_points(points, unit='km'):
@@ -87,6 +119,37 @@ def distance_between_arrays(points1, points2, unit='km'):
         return distance_km * 1000
 
 
+# Unit vectors in earth-centered coordinates from each point to the next. Steps between identical points are zero.
+def unit_steps(points):
+    lat = np.deg2rad(points['lat'])
+    lon = np.deg2rad(points['lon'])
+    cartesian = np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+    steps = np.diff(cartesian, axis=0)
+    norms = np.linalg.norm(steps, axis=1)
+    norms[norms == 0] = 1  # Avoid division by zero
+    return steps / norms[:, np.newaxis]
+
+
+# Directionality of the points from each start to end (exclusive): the length of the mean unit step, 1 for a straight
+# path and near 0 for one that keeps turning. Segments of 5 points or fewer have a directionality of 0.
+# The unit steps are computed once for all points and summed per segment with np.add.reduceat.
+def segment_directionality(points, starts, ends):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    directionality = np.zeros(len(starts))
+    valid = ends - starts > 5
+    if not np.any(valid):
+        return directionality
+
+    # A zero step at the end lets the last segment's sum end at len(points) - 1
+    steps = np.vstack([unit_steps(points), np.zeros((1, 3))])
+    # Steps of a segment are starts to ends - 2, so reduceat over (start, end - 1) pairs gives each sum
+    bounds = np.column_stack([starts[valid], ends[valid] - 1]).ravel()
+    sums = np.add.reduceat(steps, bounds, axis=0)[::2]
+    directionality[valid] = np.linalg.norm(sums, axis=1) / (ends[valid] - starts[valid] - 1)
+    return directionality
+
+
 def filter_by_date(points, date):
     year = date.year
     month = date.month
@@ -106,32 +169,52 @@ def filter_by_date(points, date):
     return points[mask]
 
 
-def smooth_trajectory(trajectory, s=None, weight="inverse", r_index=1):
-    time = trajectory['time']
+# Weight of each fix in smoothing, from its accuracy
+def smoothing_weights(trajectory, weight="inverse", r_index=1):
     if weight == "inverse":
-        weights = 1 / trajectory['accuracy']
+        return 1 / trajectory['accuracy']
     elif weight == "square":
-        weights = 1 / trajectory['accuracy'] ** 2
+        return 1 / trajectory['accuracy'] ** 2
     elif weight == "exp":
-        weights = np.exp(-trajectory['accuracy'])
+        return np.exp(-trajectory['accuracy'])
     elif weight == "neighbor":
         kernel = np.ones(r_index * 2 + 1)
         padded_accuracies = np.pad(trajectory['accuracy'], r_index, mode='edge')
-        weights = 1 / np.convolve(padded_accuracies, kernel, mode='valid')
+        return 1 / np.convolve(padded_accuracies, kernel, mode='valid')
     elif weight == "uniform":
-        weights = np.ones_like(trajectory['accuracy'])
+        return np.ones_like(trajectory['accuracy'])
     else:
         raise ValueError("Unrecognized weight method")
 
-    if s is None:
-        lat_spline = UnivariateSpline(time, trajectory['lat'], w=weights)
-        lon_spline = UnivariateSpline(time, trajectory['lon'], w=weights)
-    else:
-        lat_spline = UnivariateSpline(time, trajectory['lat'], w=weights, s=s)
-        lon_spline = UnivariateSpline(time, trajectory['lon'], w=weights, s=s)
 
-    latitude_smoothed = lat_spline(time)
-    longitude_smoothed = lon_spline(time)
+# Smooths latitude and longitude with one of:
+#   'spline': one UnivariateSpline over the whole trajectory with smoothing factor s
+#   'windowed_spline': splines over overlapping windows of window seconds, blended linearly across each overlap of
+#       overlap seconds. Every window gets the share of s of its points.
+#   'savgol': weighted least squares polynomial of degree over the half_window fixes on either side of each fix,
+#       a Savitzky-Golay filter for irregular times and accuracy weights
+#   'kalman': constant velocity Kalman filter and Rauch-Tung-Striebel smoother with the accuracy of each fix as its
+#       standard deviation in meters and process_noise as the acceleration variance in m^2/s^3. weight and s are not
+#       used.
+def smooth_trajectory(trajectory, s=None, weight="inverse", r_index=1, method="spline", window=3600, overlap=600,
+                      half_window=5, degree=2, process_noise=0.01):
+    time = trajectory['time']
+    if method == "spline":
+        weights = smoothing_weights(trajectory, weight, r_index)
+        latitude_smoothed = spline_smooth(time, trajectory['lat'], weights, s)
+        longitude_smoothed = spline_smooth(time, trajectory['lon'], weights, s)
+    elif method == "windowed_spline":
+        weights = smoothing_weights(trajectory, weight, r_index)
+        latitude_smoothed = windowed_spline_smooth(time, trajectory['lat'], weights, s, window, overlap)
+        longitude_smoothed = windowed_spline_smooth(time, trajectory['lon'], weights, s, window, overlap)
+    elif method == "savgol":
+        weights = smoothing_weights(trajectory, weight, r_index)
+        values = np.column_stack([trajectory['lat'], trajectory['lon']])
+        latitude_smoothed, longitude_smoothed = local_polynomial_smooth(time, values, weights, half_window, degree).T
+    elif method == "kalman":
+        latitude_smoothed, longitude_smoothed = kalman_smooth(trajectory, process_noise)
+    else:
+        raise ValueError("Unrecognized smoothing method")
 
     # Creating a new structured array
     smoothed_trajectory = np.zeros(len(time), dtype=position_fix_dtype)
@@ -140,3 +223,136 @@ def smooth_trajectory(trajectory, s=None, weight="inverse", r_index=1):
     smoothed_trajectory['time'] = time
 
     return smoothed_trajectory
+
+
+def spline_smooth(time, values, weights, s=None):
+    if s is None:
+        spline = UnivariateSpline(time, values, w=weights)
+    else:
+        spline = UnivariateSpline(time, values, w=weights, s=s)
+    return spline(time)
+
+
+# Windows start every window - overlap seconds. Each point is the blend of the windows covering it, weighted by how far
+# into each window it is, so the result is continuous where windows meet. Windows of fewer than 4 points, too few for a
+# cubic spline, keep their points as they are.
+def windowed_spline_smooth(time, values, weights, s, window, overlap):
+    if overlap >= window:
+        raise ValueError("overlap must be shorter than window")
+    step = window - overlap
+    window_starts = time[0] + step * np.arange(max(int(np.ceil((time[-1] - time[0] - overlap) / step)), 1))
+    bounds = np.searchsorted(time, np.column_stack([window_starts, window_starts + window]), side='left')
+    bounds[-1, 1] = len(time)
+
+    smoothed = np.zeros(len(time))
+    total_blend = np.zeros(len(time))
+    for (start, end), window_start in zip(bounds, window_starts):
+        if end - start < 4:
+            fitted = values[start:end]
+        else:
+            window_s = None if s is None else s * (end - start) / len(time)
+            fitted = spline_smooth(time[start:end], values[start:end], weights[start:end], window_s)
+        # Ramps up over the first overlap and down over the last overlap of the window
+        into = time[start:end] - window_start
+        blend = np.clip(np.minimum(into, window - into) / overlap, 0, 1) if overlap > 0 else np.ones(end - start)
+        blend = np.maximum(blend, 1e-9)
+        smoothed[start:end] += blend * fitted
+        total_blend[start:end] += blend
+    return smoothed / total_blend
+
+
+# Weighted least squares fit of a polynomial in time around every point to (n, d) values, evaluated at the point.
+# All n systems are solved at once. Times are centered on each point and scaled by the window span to keep them well
+# conditioned, and points past either end of the trajectory get zero weight.
+def local_polynomial_smooth(time, values, weights, half_window, degree):
+    n = len(time)
+    offsets = np.arange(-half_window, half_window + 1)
+    neighbors = np.arange(n)[:, np.newaxis] + offsets
+    valid = (neighbors >= 0) & (neighbors < n)
+    neighbors = np.clip(neighbors, 0, n - 1)
+
+    dt = time[neighbors] - time[:, np.newaxis]
+    scale = np.max(np.abs(dt), axis=1, keepdims=True)
+    dt = dt / np.where(scale > 0, scale, 1.0)
+    w = np.where(valid, weights[neighbors], 0.0)
+
+    # Vandermonde rows of every neighbor, shape (n, 2 * half_window + 1, degree + 1)
+    basis = dt[..., np.newaxis] ** np.arange(degree + 1)
+    normal = np.einsum('nk,nki,nkj->nij', w, basis, basis)
+    right = np.einsum('nk,nki,nkd->nid', w, basis, values[neighbors])
+    # The pseudo inverse handles windows with fewer distinct times than coefficients
+    coefficients = np.linalg.pinv(normal) @ right
+    return coefficients[:, 0, :]
+
+
+# Positions are filtered in meters on a plane tangent at the mean latitude. Both axes share the same motion and noise
+# model, so the covariances and gains depend only on the times and accuracies and apply to x and y alike. The gains of
+# the smoother are computed for all points at once.
+# Unlike the other methods, the forward filter and the backward smoother pass are loops over the points: each step
+# depends on the one before it through the covariance update, which is not a cumulative operation NumPy can express.
+# They run on plain floats, which takes under a second for a day of fixes at 1 Hz.
+def kalman_smooth(trajectory, process_noise=0.01):
+    meters_per_degree = 6378137.0 * np.pi / 180
+    lat0 = np.radians(np.mean(trajectory['lat']))
+    origin_lat, origin_lon = trajectory['lat'][0], trajectory['lon'][0]
+    ys = ((trajectory['lat'] - origin_lat) * meters_per_degree).tolist()
+    xs = ((trajectory['lon'] - origin_lon) * meters_per_degree * np.cos(lat0)).tolist()
+    variances = (np.maximum(trajectory['accuracy'], 1e-3) ** 2).tolist()
+    dts = np.diff(trajectory['time'], prepend=trajectory['time'][0]).tolist()
+    n = len(xs)
+
+    # Covariance [[p00, p01], [p01, p11]] of (position, velocity) after each prediction and each update
+    predicted = np.zeros((n, 3))
+    filtered = np.zeros((n, 3))
+    # Filtered (x, vx, y, vy) and predicted positions and velocities
+    states = np.zeros((n, 4))
+    predicted_states = np.zeros((n, 4))
+
+    p00, p01, p11 = variances[0], 0.0, 100.0
+    x, vx, y, vy = xs[0], 0.0, ys[0], 0.0
+    for i in range(n):
+        dt = dts[i]
+        if i > 0:
+            p00 = p00 + 2 * dt * p01 + dt * dt * p11 + process_noise * dt ** 3 / 3
+            p01 = p01 + dt * p11 + process_noise * dt * dt / 2
+            p11 = p11 + process_noise * dt
+            x, y = x + dt * vx, y + dt * vy
+        predicted[i] = p00, p01, p11
+        predicted_states[i] = x, vx, y, vy
+
+        # Only the position is measured
+        k0 = p00 / (p00 + variances[i])
+        k1 = p01 / (p00 + variances[i])
+        x_residual, y_residual = xs[i] - x, ys[i] - y
+        x, vx = x + k0 * x_residual, vx + k1 * x_residual
+        y, vy = y + k0 * y_residual, vy + k1 * y_residual
+        p00, p01, p11 = p00 - k0 * p00, p01 - k0 * p01, p11 - k1 * p01
+        filtered[i] = p00, p01, p11
+        states[i] = x, vx, y, vy
+
+    # Smoother gains C = P F^T inverse(P_predicted) of points 0 to n - 2
+    f00, f01, f11 = filtered[:-1].T
+    q00, q01, q11 = predicted[1:].T
+    dt = np.asarray(dts[1:])
+    m00, m01, m10, m11 = f00 + dt * f01, f01, f01 + dt * f11, f11
+    determinant = q00 * q11 - q01 * q01
+    c00 = (m00 * q11 - m01 * q01) / determinant
+    c01 = (m01 * q00 - m00 * q01) / determinant
+    c10 = (m10 * q11 - m11 * q01) / determinant
+    c11 = (m11 * q00 - m10 * q01) / determinant
+    gains = np.column_stack([c00, c01, c10, c11]).tolist()
+
+    smoothed = states.tolist()
+    predicted_states = predicted_states.tolist()
+    for i in range(n - 2, -1, -1):
+        g00, g01, g10, g11 = gains[i]
+        after, prediction, current = smoothed[i + 1], predicted_states[i + 1], smoothed[i]
+        dx, dvx = after[0] - prediction[0], after[1] - prediction[1]
+        dy, dvy = after[2] - prediction[2], after[3] - prediction[3]
+        smoothed[i] = [current[0] + g00 * dx + g01 * dvx, current[1] + g10 * dx + g11 * dvx,
+                       current[2] + g00 * dy + g01 * dvy, current[3] + g10 * dy + g11 * dvy]
+    smoothed = np.array(smoothed)
+
+    latitude = origin_lat + smoothed[:, 2] / meters_per_degree
+    longitude = origin_lon + smoothed[:, 0] / (meters_per_degree * np.cos(lat0))
+    return latitude, longitude
@@ -0,0 +1,90 @@
+import numpy as np
+
+
+# Silhouettes of stop regions computed over all of their points at once.
+# The points are stacked into one array sorted by region, and the haversine distances from a block of points to every
+# point are summed per region with np.add.reduceat. A block has about block_elements distances whatever the number of
+# points, and the distances are computed in place in two reused buffers, so besides arrays of one value per point the
+# memory used is about 2 * block_elements * 8 bytes (160 MB for the default).
+BLOCK_ELEMENTS = 10_000_000
+
+
+# Returns the lat, lon radians of the points of all stop regions, and the region of each point
+def stack_stop_regions(stop_regions):
+    lat = np.radians(np.concatenate([stop_region.points['lat'] for stop_region in stop_regions]))
+    lon = np.radians(np.concatenate([stop_region.points['lon'] for stop_region in stop_regions]))
+    labels = np.repeat(np.arange(len(stop_regions)), [len(stop_region.points) for stop_region in stop_regions])
+    return lat, lon, labels
+
+
+# km between each point in (lat1, lon1) and each point in (lat2, lon2), all in radians.
+# The result is written to out, and work is used for the longitude term. Both are allocated if not given.
+def haversine_matrix(lat1, lon1, lat2, lon2, out=None, work=None):
+    shape = (len(lat1), len(lat2))
+    out = np.empty(shape) if out is None else out
+    work = np.empty(shape) if work is None else work
+
+    # sin(lat_diff / 2) ** 2
+    np.subtract(lat1[:, np.newaxis], lat2[np.newaxis, :], out=out)
+    out *= 0.5
+    np.sin(out, out=out)
+    np.square(out, out=out)
+    # cos(lat1) * cos(lat2) * sin(lon_diff / 2) ** 2
+    np.subtract(lon1[:, np.newaxis], lon2[np.newaxis, :], out=work)
+    work *= 0.5
+    np.sin(work, out=work)
+    np.square(work, out=work)
+    work *= np.cos(lat1)[:, np.newaxis]
+    work *= np.cos(lat2)[np.newaxis, :]
+
+    out += work
+    np.minimum(out, 1.0, out=out)
+    np.sqrt(out, out=out)
+    np.arcsin(out, out=out)
+    out *= 2 * 6378.137
+    return out
+
+
+# Rows of a block, so a block of distances to every point has about block_elements values
+def block_rows(point_count, block_elements=BLOCK_ELEMENTS):
+    return int(max(1, min(point_count, block_elements // max(point_count, 1))))
+
+
+# Yields (start, end, sums) for blocks of points, where sums are the distances from points start to end to the points
+# of each region, shape (end - start, regions). Points must be sorted by label and labels must be 0 to regions - 1.
+def region_distance_sums(lat, lon, labels, block_elements=BLOCK_ELEMENTS):
+    starts = np.searchsorted(labels, np.arange(labels[-1] + 1), side='left')
+    rows = block_rows(len(lat), block_elements)
+    out = np.empty((rows, len(lat)))
+    work = np.empty((rows, len(lat)))
+    for start in range(0, len(lat), rows):
+        end = min(start + rows, len(lat))
+        distances = haversine_matrix(lat[start:end], lon[start:end], lat, lon, out[:end - start], work[:end - start])
+        yield start, end, np.add.reduceat(distances, starts, axis=1)
+
+
+# Silhouette of every point: (b - a) / max(a, b), where a is the mean distance to the other points of its region and b
+# the smallest mean distance to the points of another region. Points alone in their region have a silhouette of 0.
+def point_silhouettes(lat, lon, labels, block_elements=BLOCK_ELEMENTS):
+    counts = np.bincount(labels)
+    a = np.empty(len(labels))
+    b = np.empty(len(labels))
+    for start, end, sums in region_distance_sums(lat, lon, labels, block_elements):
+        points = np.arange(end - start)
+        own_labels = labels[start:end]
+        a[start:end] = sums[points, own_labels] / np.maximum(counts[own_labels] - 1, 1)
+        means = sums / counts
+        means[points, own_labels] = np.inf
+        b[start:end] = np.min(means, axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        silhouettes = (b - a) / np.maximum(a, b)
+    silhouettes[(counts[labels] == 1) | ~np.isfinite(silhouettes)] = 0.0
+    return silhouettes
+
+
+# Mean silhouette of the points of each stop region
+def region_silhouettes(stop_regions, block_elements=BLOCK_ELEMENTS):
+    lat, lon, labels = stack_stop_regions(stop_regions)
+    silhouettes = point_silhouettes(lat, lon, labels, block_elements)
+    return np.bincount(labels, weights=silhouettes) / np.bincount(labels)
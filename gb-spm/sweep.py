@@ -0,0 +1,190 @@
+import os
+import csv
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from batch import share_points, attach_points, shared_points, release_points
+from position_fix_utils import smooth_trajectory
+from TrajectoryContext import TrajectoryContext
+from gb_spm import (
+    characteristic_indices,
+    max_weight_graph,
+    cut_distant_parents,
+    propagate_labels,
+    generate_stop_regions,
+    mean_silhouette,
+)
+from silhouette import BLOCK_ELEMENTS
+
+
+# Parameters of a sweep in the order of the stages that use them. s is the smoothing factor per point.
+grid_fields = ['s', 'weight', 'r_index', 'max_velocity', 'max_dist', 'max_time']
+default_grid = {
+    's': [5e-11],
+    'weight': ['inverse'],
+    'r_index': [3],
+    'max_velocity': [1],
+    'max_dist': [0.25],
+    'max_time': [120],
+}
+result_fields = ['date'] + grid_fields + ['stops', 'silhouette']
+
+# Memory of a worker: the interpreter with its modules and the silhouette buffers, and for each point of its day the
+# trajectory, its context and the arrays of one cached stage.
+WORKER_BYTES = 100 * 2 ** 20 + 2 * BLOCK_ELEMENTS * 8
+POINT_BYTES = 1024
+
+
+# Every combination of the values in grid, with default_grid values for the fields it does not give
+def parameter_grid(grid):
+    unknown = set(grid) - set(grid_fields)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown sweep parameters: {sorted(unknown)}")
+    values = [grid.get(field, default_grid[field]) for field in grid_fields]
+    return [dict(zip(grid_fields, combination)) for combination in itertools.product(*values)]
+
+
+# Runs GB-SPM for every point of grid on every (date, points) day, one day per process, and writes one row per day and
+# grid point to output_path. Returns the rows.
+# As in batch.run_batch, the days are copied once into a shared memory block and each job only sends the offsets of its
+# day, so no trajectory is pickled. The number of workers (one per core if None) is capped so the workers fit in the
+# available memory.
+def run_sweep(days, grid, output_path=None, workers=None, smoothing_r_index=1, cp_r_index=4, dist_mult=60,
+              min_points=4):
+    grid_points = parameter_grid(grid)
+    days = [(str(date), points) for date, points in days if len(points) >= min_points]
+    if len(days) == 0:
+        return []
+    points = np.concatenate([day_points for _, day_points in days])
+    offsets = np.cumsum([0] + [len(day_points) for _, day_points in days])
+
+    rows = []
+    block = share_points(points)
+    try:
+        jobs = [(date, block.name, points.dtype.descr, len(points), int(offsets[i]), int(offsets[i + 1]), grid_points,
+                 smoothing_r_index, cp_r_index, dist_mult) for i, (date, _) in enumerate(days)]
+        workers = memory_workers(workers, worker_bytes(grid_points, np.max(np.diff(offsets))))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for day_rows in executor.map(sweep_day, jobs):
+                rows.extend(day_rows)
+    finally:
+        release_points(block)
+
+    if output_path is not None:
+        with open(output_path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(result_fields)
+            writer.writerows(rows)
+    return rows
+
+
+# Memory a worker needs for days of up to max_points fixes, with one set of arrays per cached stage of the grid
+def worker_bytes(grid_points, max_points):
+    smoothing_keys = {(p['s'], p['weight']) for p in grid_points}
+    cp_keys = {(p['s'], p['weight'], p['max_velocity']) for p in grid_points}
+    graph_keys = {(p['s'], p['weight'], p['max_velocity'], p['r_index']) for p in grid_points}
+    cached = len(smoothing_keys) + len(cp_keys) + len(graph_keys)
+    return WORKER_BYTES + POINT_BYTES * int(max_points) * (1 + cached)
+
+
+# Number of workers, at most one per core or the given number, that fit in the available memory. At least one.
+def memory_workers(workers, bytes_per_worker):
+    workers = workers or os.cpu_count() or 1
+    memory = available_memory()
+    if memory is None:
+        return workers
+    return max(1, min(workers, memory // bytes_per_worker))
+
+
+# Bytes of memory available to new processes, or None if it cannot be read
+def available_memory():
+    try:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+# Runs the grid on one day. Each stage is computed once for the parameters it depends on and shared by every grid
+# point that only differs in later parameters: smoothing by (s, weight), CPs also by max_velocity, the max weight graph
+# also by r_index. Only the cut by max_dist and max_time and the stop regions are computed for every grid point.
+def sweep_day(job):
+    date, block_name, dtype_descr, count, start, end, grid_points, smoothing_r_index, cp_r_index, dist_mult = job
+    block = attach_points(block_name)
+    try:
+        points = shared_points(block, dtype_descr, count)
+        rows = sweep_points(date, points[start:end], grid_points, smoothing_r_index, cp_r_index, dist_mult)
+        del points
+        return rows
+    finally:
+        block.close()
+
+
+def sweep_points(date, points, grid_points, smoothing_r_index, cp_r_index, dist_mult):
+    smoothed_cache = {}
+    cp_cache = {}
+    graph_cache = {}
+
+    rows = []
+    for parameters in grid_points:
+        s, weight, r_index, max_velocity, max_dist, max_time = (parameters[field] for field in grid_fields)
+
+        smoothing_key = (s, weight)
+        if smoothing_key not in smoothed_cache:
+            smoothed = smooth_trajectory(points, s=s * len(points), weight=weight, r_index=smoothing_r_index)
+            smoothed_cache[smoothing_key] = smoothed, TrajectoryContext(smoothed)
+        smoothed, context = smoothed_cache[smoothing_key]
+
+        cp_key = smoothing_key + (max_velocity,)
+        if cp_key not in cp_cache:
+            cp_cache[cp_key] = characteristic_indices(smoothed, cp_r_index, max_velocity, context=context)
+        cp_indices = cp_cache[cp_key]
+
+        stop_regions = []
+        if len(cp_indices) > 1:
+            graph_key = cp_key + (r_index,)
+            if graph_key not in graph_cache:
+                graph_cache[graph_key] = max_weight_graph(smoothed, cp_indices, r_index, dist_mult, context=context)
+            max_weight_indices, band_distances = graph_cache[graph_key]
+
+            max_weight_indices = cut_distant_parents(smoothed, cp_indices, max_weight_indices, band_distances,
+                                                     max_dist, max_time)
+            stop_regions = generate_stop_regions(smoothed, cp_indices, propagate_labels(max_weight_indices))
+
+        rows.append([date, s, weight, r_index, max_velocity, max_dist, max_time, len(stop_regions),
+                     mean_silhouette(stop_regions)])
+    return rows
+
+
+# Returns (parameters, mean, std, days) of the silhouettes of each grid point over the days where it is defined,
+# best mean first
+def summarize(rows):
+    silhouettes = {}
+    for row in rows:
+        parameters = tuple(row[1:1 + len(grid_fields)])
+        silhouettes.setdefault(parameters, [])
+        if row[-1] is not None:
+            silhouettes[parameters].append(row[-1])
+
+    summary = []
+    for parameters, values in silhouettes.items():
+        mean = np.mean(values) if len(values) > 0 else np.nan
+        std = np.std(values) if len(values) > 0 else np.nan
+        summary.append((dict(zip(grid_fields, parameters)), mean, std, len(values)))
+    summary.sort(key=lambda result: -np.inf if np.isnan(result[1]) else result[1], reverse=True)
+    return summary
+
+
+if __name__ == '__main__':
+    from utils import absolute_path
+    from TrajectoryStore import open_store
+    store = open_store(absolute_path("../data/andrew-device-locations-all.csv"), accuracy_threshold=80)
+    sweep_rows = run_sweep(store.days(), {'s': [1e-10, 5e-11, 1e-11, 5e-12, 1e-12]}, absolute_path('sweep.csv'))
+    for sweep_parameters, sweep_mean, sweep_std, sweep_days in summarize(sweep_rows):
+        print(sweep_mean, sweep_std, sweep_days, sweep_parameters)
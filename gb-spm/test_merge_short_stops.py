@@ -0,0 +1,27 @@
+import numpy as np
+from position_fix_utils import position_fix_dtype
+from StopRegionSet import StopRegionSet
+from gb_spm import merge_short_stops
+
+
+# One stop per (entry, exit) visit, each with a single point
+def single_visit_stops(visits):
+    points = np.zeros(len(visits), dtype=position_fix_dtype)
+    points['lat'] = np.arange(len(visits))
+    points['time'] = [entry for entry, _ in visits]
+    return StopRegionSet(points, np.arange(len(visits) + 1), [entry for entry, _ in visits],
+                         [exit for _, exit in visits], np.arange(len(visits) + 1))
+
+
+# The first stop gives its visit to the second, which then has two visits and is kept. The third still gives its visit
+# to the second, as the second was not absorbed.
+def test_chain_of_close_stops():
+    merged = merge_short_stops(single_visit_stops([(0, 10), (20, 30), (35, 45), (1000, 2000)]), 300, 120)
+    assert len(merged) == 2
+    assert merged.entry_times.tolist() == [20, 0, 35, 1000]
+    assert merged.visit_offsets.tolist() == [0, 3, 4]
+
+
+def test_distant_stops_are_kept():
+    merged = merge_short_stops(single_visit_stops([(0, 10), (500, 600), (1000, 2000)]), 300, 120)
+    assert len(merged) == 3
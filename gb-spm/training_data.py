@@ -1,9 +1,9 @@
 import numpy as np
-import csv
 from utils import absolute_path
 import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
-from position_fix_utils import filter_by_date, smooth_trajectory
+import position_fix_utils
+from position_fix_utils import filter_by_date, smooth_trajectory, DayPartition, segment_directionality
 from gb_spm import characteristic_indices, significant_place_mining
 import webbrowser
 from MapPlot import MapPlot
@@ -24,30 +24,16 @@ position_fix_dtype = np.dtype([
 
 
 def position_fix_from_csv(file_path, remove_duplicates=True):
-    data = []
-    with open(file_path, 'r') as file:
-        reader = csv.DictReader(file)
-        prior = None
-        for row in reader:
-            point = (
-                float(row['latitude']),
-                float(row['longitude']),
-                float(row['create_time_epoch']),
-                # float(row['altitude']),
-                float(row['bearing']),
-                float(row['speed']),
-                float(row['accuracy']),
-                # float(row['vertical_accuracy']),
-                float(row['bearing_accuracy']),
-                float(row['speed_accuracy']),
-            )
-            if remove_duplicates:
-                if prior is not None and prior == point:
-                    continue
-                else:
-                    prior = point
-            data.append(point)
-    return np.array(data, dtype=position_fix_dtype)
+    return position_fix_utils.position_fix_from_csv(file_path, remove_duplicates, dtype=position_fix_dtype)
+
+
+# Feature column with the directionality of the r_index points on either side of each point, cut at the ends of the
+# data. Needs r_index of at least 3 for windows of more than 5 points.
+def directionality_feature(data, r_index=4):
+    indices = np.arange(len(data))
+    starts = np.maximum(indices - r_index, 0)
+    ends = np.minimum(indices + r_index + 1, len(data))
+    return segment_directionality(data, starts, ends)
 
 
 # RESULTS: altitude and vertical accuracy may be unnecessary.
@@ -69,9 +55,10 @@ def show_covariance_matrix(data):
 def all_days(data):
     date_range = (datetime(2024, 4, 15), datetime(2024, 5, 22))
 
+    days = DayPartition(data)
     current_date = date_range[0]
     while current_date <= date_range[1]:
-        day_data = filter_by_date(location_data, current_date)
+        day_data = days.day(current_date)
         current_date += timedelta(days=1)
 
 
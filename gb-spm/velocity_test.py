@@ -3,101 +3,121 @@ from position_fix_utils import (
     position_fix_dtype,
     position_fix_from_csv,
     filter_by_date,
+    DayPartition,
+    distance_between_arrays,
+    segment_directionality,
 )
-from datetime import datetime, timedelta
+from datetime import datetime
 import numpy as np
 from LabelPlot import LabelPlot
 import webbrowser
-from Region import Region, recursive_merge
-from geopy import distance
-
-
+import shapely
+from shapely import STRtree
+from Region import Region, recursive_merge, intersection_ratios
+import common_path  # noqa: F401
+from SegmentTable import SegmentTable
+
+
+# Adds a point at every label boundary, placed where the person would have been at the end of the move, or at the start
+# of it for the end of a stop, given the distance across the boundary and the speed of the moving side.
+# The output is built in one allocation: point i of trajectory goes to index_map[i] and the point added after boundary
+# k to region_ends[k] + k + 1. With return_index_map the index map is also returned, so arrays over the trajectory can
+# be projected onto the interpolated one with result[index_map] = values.
 # TODO: use filtered subtrajectories
-def interpolate_edges(trajectory, labels):
+def interpolate_edges(trajectory, labels, return_index_map=False):
+    labels = np.asarray(labels)
     region_ends = np.where(np.diff(labels) != 0)[0]
-    new_points = np.zeros((len(region_ends)), dtype=position_fix_dtype)
-    for i in range(len(region_ends)):
-        end_index = region_ends[i]
-        start_index = end_index + 1
-        dist = distance.distance(trajectory[['lat', 'lon']][end_index],
-                                 trajectory[['lat', 'lon']][start_index]).meters
-        # end of a move
-        if labels[end_index] == 0:
-            new_points[i] = trajectory[start_index].copy()
-            expected_travel_time = dist / trajectory[end_index]['speed']
-            new_points[i]['time'] = trajectory[end_index]['time'] + expected_travel_time
-
-        # end of a stop
-        elif labels[end_index] == 1:
-            new_points[i] = trajectory[end_index].copy()
-            expected_travel_time = dist / trajectory[start_index]['speed']
-            new_points[i]['time'] = trajectory[start_index]['time'] - expected_travel_time
-
-    result_array = trajectory.copy()
-    for i, idx in enumerate(region_ends):
-        result_array = np.insert(result_array, idx + i + 1, new_points[i])
+    region_starts = region_ends + 1
+    dist = distance_between_arrays(trajectory[region_ends], trajectory[region_starts], unit='m')
 
+    new_points = np.zeros((len(region_ends)), dtype=position_fix_dtype)
+    # end of a move
+    move_ends = labels[region_ends] == 0
+    new_points[move_ends] = trajectory[region_starts[move_ends]]
+    new_points['time'][move_ends] = (trajectory['time'][region_ends[move_ends]] +
+                                     dist[move_ends] / trajectory['speed'][region_ends[move_ends]])
+
+    # end of a stop
+    stop_ends = labels[region_ends] == 1
+    new_points[stop_ends] = trajectory[region_ends[stop_ends]]
+    new_points['time'][stop_ends] = (trajectory['time'][region_starts[stop_ends]] -
+                                     dist[stop_ends] / trajectory['speed'][region_starts[stop_ends]])
+
+    index_map = np.arange(len(trajectory)) + np.searchsorted(region_ends, np.arange(len(trajectory)), side='left')
+    result_array = np.zeros(len(trajectory) + len(region_ends), dtype=trajectory.dtype)
+    result_array[index_map] = trajectory
+    result_array[region_ends + np.arange(len(region_ends)) + 1] = new_points
+
+    if return_index_map:
+        return result_array, index_map
     return result_array
 
 
+# Gives the to_replace label to the runs of to_remove shorter than time_threshold seconds and, if point_threshold is
+# given, with fewer points than it. labels is updated in place and returned.
 def remove_short_regions(trajectory, labels, to_remove, to_replace, time_threshold=60, point_threshold=None):
-    subtrajectories, starts, ends = get_filtered_subtrajectories(trajectory, labels, to_remove, True)
-
-    for i in range(len(subtrajectories)):
-        time_diff = np.diff(subtrajectories[i]['time'][[0, -1]])[0]
-        if time_diff < time_threshold:
-            if point_threshold is None or ends[i] - starts[i] < point_threshold:
-                labels[starts[i]:ends[i]] = to_replace
-
+    table = SegmentTable.from_labels(trajectory, labels)
+    short = (table.labels == to_remove) & (table.durations < time_threshold)
+    if point_threshold is not None:
+        short &= table.counts < point_threshold
+    labels[:] = table.relabel(short, to_replace).point_labels()
     return labels
 
 
 def vector_directionality(trajectory) -> float:
-    if len(trajectory) <= 5:
-        return 0.0
-    lat_rad = np.deg2rad(trajectory['lat'])
-    lon_rad = np.deg2rad(trajectory['lon'])
-    x = np.cos(lat_rad) * np.cos(lon_rad)
-    y = np.cos(lat_rad) * np.sin(lon_rad)
-    z = np.sin(lat_rad)
-    cartesian_coords = np.array([x, y, z]).T
-
-    difference = np.diff(cartesian_coords, axis=0)
-    norms = np.linalg.norm(difference, axis=1)
-    norms[norms == 0] = 1  # Avoid division by zero
-    diff_normalized = difference / norms[:, np.newaxis]
-    mean_vec = np.mean(diff_normalized, axis=0)
-    return np.linalg.norm(mean_vec)
+    return float(segment_directionality(trajectory, [0], [len(trajectory)])[0])
 
 
 def get_filtered_subtrajectories(trajectory, labels, label, return_boundaries=False):
-    difference = np.diff((labels == label).astype(int))
-    starts = np.where(difference == 1)[0] + 1
-    ends = np.where(difference == -1)[0] + 1
-    if labels[0] == label:
-        starts = np.insert(starts, 0, 0)
-    if labels[-1] == label:
-        ends = np.append(ends, len(labels))
-    subtrajectories = [trajectory[starts[i]:ends[i]] for i in range(len(starts))]
+    table = SegmentTable.from_labels(trajectory, labels)
+    rows = table.rows(label)
+    subtrajectories = list(table.segments(label))
     if return_boundaries:
-        return subtrajectories, starts, ends
+        return subtrajectories, table.starts[rows], table.ends[rows]
     else:
         return subtrajectories
 
 
+# Walks (label 2) overlapping a stop region by more than threshold become stops and the other walks become moves.
+# Walks are lines through their points, or a point if they start and end at the same place as in Region. The stop
+# shapes are indexed in an STRtree, every walk is queried at once and only the intersecting pairs are measured.
+# labels is updated in place and returned. Without stop regions the walks are left as they are.
 def classify_walks_by_intersection(stop_regions, trajectory, labels, threshold):
-    subtrajectories, starts, stops = get_filtered_subtrajectories(trajectory, labels, 2, True)
-    walk_regions = [Region(i, 2) for i in subtrajectories]
-
-    for i in range(len(walk_regions)):
-        for stop in stop_regions:
-            if stop.percent_intersection(walk_regions[i]) > threshold:
-                labels[starts[i]:stops[i]] = 1
-                break
-            labels[starts[i]:stops[i]] = 0
+    table = SegmentTable.from_labels(trajectory, labels)
+    walks = table.rows(2)
+    if len(stop_regions) == 0 or len(walks) == 0:
+        return labels
+
+    walk_shapes = walk_geometries(trajectory, table.starts[walks], table.ends[walks])
+    stop_shapes = np.array([stop.shape for stop in stop_regions])
+    walk_indices, stop_indices = STRtree(stop_shapes).query(walk_shapes, predicate='intersects')
+    ratios = intersection_ratios(stop_shapes[stop_indices], walk_shapes[walk_indices])
+
+    inside = np.zeros(len(walks), dtype=bool)
+    inside[walk_indices[ratios > threshold]] = True
+    row_labels = table.labels.copy()
+    row_labels[walks] = np.where(inside, 1, 0)
+    labels[:] = np.repeat(row_labels, table.counts)
     return labels
 
 
+# Line through the points of each run from starts to ends, or its first point if it ends where it starts
+def walk_geometries(trajectory, starts, ends):
+    coordinates = np.column_stack([trajectory['lon'], trajectory['lat']])
+    closed = np.all(coordinates[starts] == coordinates[ends - 1], axis=1)
+    shapes = np.empty(len(starts), dtype=object)
+    shapes[closed] = shapely.points(coordinates[starts[closed]])
+
+    line_starts, line_ends = starts[~closed], ends[~closed]
+    if len(line_starts) == 0:
+        return shapes
+    counts = line_ends - line_starts
+    # Indices of the points of every line, one line after the other
+    point_indices = np.repeat(line_starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    shapes[~closed] = shapely.linestrings(coordinates[point_indices], indices=np.repeat(np.arange(len(counts)), counts))
+    return shapes
+
+
 def show_speed_map(trajectory):
     labels = trajectory['speed'] < 1.5
 
@@ -128,7 +148,10 @@ def show_speed_map(trajectory):
 
 def given_day(data, day):
     # Filter to one day
-    day_trajectory = filter_by_date(data, day)
+    show_day(filter_by_date(data, day))
+
+
+def show_day(day_trajectory):
     if len(day_trajectory) < 2:
         return
 
@@ -136,15 +159,8 @@ def given_day(data, day):
 
 
 def day_by_day(data):
-    start = data[0]['time']
-    end = data[-1]['time']
-    start_date = datetime.utcfromtimestamp(start)
-    end_date = datetime.utcfromtimestamp(end)
-
-    current_date = start_date
-    while current_date <= end_date:
-        current_date += timedelta(days=1)
-        given_day(data, current_date)
+    for _, day_trajectory in DayPartition(data):
+        show_day(day_trajectory)
 
 
 if __name__ == '__main__':
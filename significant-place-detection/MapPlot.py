@@ -3,15 +3,17 @@ from ipyleaflet import (
     Polyline,
     Popup,
     Marker,
-    CircleMarker
 )
 from ipywidgets import Layout, HTML
 import numpy as np
 from datetime import datetime, timedelta
 from shapely.geometry import Polygon
+import common_path  # noqa: F401
+from SegmentTable import SegmentTable
+from FeatureLayers import FeatureLayers
 
 
-class MapPlot(Map):
+class MapPlot(FeatureLayers, Map):
     def __init__(self, height='1250px'):
         super().__init__(
             scroll_wheel_zoom=True,
@@ -25,28 +27,18 @@ class MapPlot(Map):
         self.add(polyline)
         self.set_coordinate_ranges(points)
 
+    # One polyline per run of labels, with moves and walks extended to the points around them so the curve is connected
     def add_labeled_curve(self, trajectory, labels):
         point_list = trajectory.view((np.float64, len(trajectory.dtype.fields)))[:, 0:2].tolist()
+        table = SegmentTable.from_labels(trajectory, labels)
 
-        current_label = labels[0]
-        current_segment = [point_list[0]]
-        for i in range(1, len(labels)):
-            if labels[i] != current_label or i == len(labels) - 1:
-                color = 'red' if current_label == 1 else 'green' if current_label == 0 else 'blue'
-                # add adjacent points
-                if current_label == 0 or current_label == 2:
-                    last_index = i - len(current_segment) - 1
-                    next_index = i
-                    if last_index >= 0:
-                        current_segment.insert(0, point_list[last_index])
-                    if next_index < len(point_list):
-                        current_segment.append(point_list[next_index])
-                polyline = Polyline(locations=current_segment, color=color, weight=2, fill=False)
-                self.add(polyline)
-                current_label = labels[i]
-                current_segment = []
-
-            current_segment.append(point_list[i])
+        for label, start, end in zip(table.labels.tolist(), table.starts.tolist(), table.ends.tolist()):
+            color = 'red' if label == 1 else 'green' if label == 0 else 'blue'
+            # add adjacent points
+            if label == 0 or label == 2:
+                start, end = max(start - 1, 0), min(end + 1, len(point_list))
+            polyline = Polyline(locations=point_list[start:end], color=color, weight=2, fill=False)
+            self.add(polyline)
         self.set_coordinate_ranges(trajectory)
 
     def add_regions(self, regions, color='red', markers=True):
@@ -96,27 +88,29 @@ class MapPlot(Map):
         if labels is None:
             labels = np.zeros(len(points))
 
-        for i in range(len(points)):
-            location = (points[i]['lat'], points[i]['lon'])
-            color = 'red' if labels[i] == 1 else 'green' if labels[i] == 0 else 'blue'
-            marker = CircleMarker(location=location, radius=2, color=color)
-            if time_popup:
-                marker.popup = Popup(
-                    location=location,
-                    child=HTML(value=(
-                            (datetime.utcfromtimestamp(points[i]['time'])-timedelta(hours=4)).strftime("%B %d %H:%M:%S")
-                            + f"<br>Index: {i}"
-                            + f"<br>Speed: {points[i]['speed']}"
-                            + f"<br>Calculated Speed: {points[i]['distance'] / points[i]['time_diff']}"
-                            + f"<br>Accuracy: {points[i]['accuracy']}"
-                            + f"<br>Distance: {points[i]['distance']}")),
-                    close_button=False,
-                    auto_close=False,
-                    close_on_escape_key=False
-                )
-            self.add(marker)
+        labels = np.asarray(labels)
+        colors = np.where(labels == 1, 'red', np.where(labels == 0, 'green', 'blue'))
+        popups = self.point_popups(points) if time_popup else None
+        self.add_point_layer(points, colors, popups)
         self.set_coordinate_ranges(points)
 
+    # Popup text of each point with its time, index, speeds, accuracy and distance
+    @staticmethod
+    def point_popups(points):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            calculated_speeds = (points['distance'] / points['time_diff']).tolist()
+        times = [(datetime.utcfromtimestamp(time) - timedelta(hours=4)).strftime("%B %d %H:%M:%S")
+                 for time in points['time'].tolist()]
+        speeds = points['speed'].tolist()
+        accuracies = points['accuracy'].tolist()
+        distances = points['distance'].tolist()
+        return [times[i]
+                + f"<br>Index: {i}"
+                + f"<br>Speed: {speeds[i]}"
+                + f"<br>Calculated Speed: {calculated_speeds[i]}"
+                + f"<br>Accuracy: {accuracies[i]}"
+                + f"<br>Distance: {distances[i]}" for i in range(len(times))]
+
     def set_coordinate_ranges(self, points):
         bounds = None
         if isinstance(points, Polygon):
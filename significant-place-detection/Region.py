@@ -1,50 +1,128 @@
+import shapely
 from shapely.geometry import Point, LineString
 import numpy as np
-from geopy.distance import distance
+from convex_distance import convex_distance, haversine_distance
+import common_path  # noqa: F401
+from GridIndex import merge_regions
+from hull import hull_vertices
+from SegmentTable import SegmentTable
 
 
 def get_filtered_subtrajectories(trajectory, labels, label, return_boundaries=False):
-    difference = np.diff((labels == label).astype(int))
-    starts = np.where(difference == 1)[0] + 1
-    ends = np.where(difference == -1)[0] + 1
-    if labels[0] == label:
-        starts = np.insert(starts, 0, 0)
-    if labels[-1] == label:
-        ends = np.append(ends, len(labels))
-    subtrajectories = [trajectory[starts[i]:ends[i]] for i in range(len(starts))]
+    table = SegmentTable.from_labels(trajectory, labels)
+    rows = table.rows(label)
+    subtrajectories = list(table.segments(label))
     if return_boundaries:
-        return subtrajectories, starts, ends
+        return subtrajectories, table.starts[rows], table.ends[rows]
     else:
         return subtrajectories
 
 
-def stop_regions_from_trajectory(trajectory, labels, distance_threshold=500):
-    consecutive_points = get_filtered_subtrajectories(trajectory, labels, 1)
-
-    regions = []
-    while len(consecutive_points) > 0:
-        points = consecutive_points.pop(0)
-        for j in range(len(points) - 1):
-            # split if points are far apart
-            if points[j + 1]['distance'] > min(distance_threshold, points[j]['accuracy'] + points[j]['accuracy'] + 30):
-                consecutive_points.insert(0, points[j + 1:])
-                points = points[:j + 1]
-                break
-        regions.append(Region(points, 1))
-    return regions
+# Returns the (start, end) index pairs of the runs of stop labels, where each run is also split between j and j + 1
+# wherever split[j] is True. split has one entry per pair of consecutive points.
+def stop_segments(labels, split):
+    stop = np.asarray(labels) == 1
+    if len(stop) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    edges = np.diff(stop.astype(np.int8))
+    run_starts = np.nonzero(edges == 1)[0] + 1
+    run_ends = np.nonzero(edges == -1)[0] + 1
+    if stop[0]:
+        run_starts = np.insert(run_starts, 0, 0)
+    if stop[-1]:
+        run_ends = np.append(run_ends, len(stop))
+    # Splits inside a run end one segment and start the next
+    splits = np.nonzero(np.asarray(split) & stop[:-1] & stop[1:])[0] + 1
+    return np.sort(np.concatenate([run_starts, splits])), np.sort(np.concatenate([splits, run_ends]))
 
 
+def stop_regions_from_trajectory(trajectory, labels, distance_threshold=500):
+    # split if points are far apart
+    accuracy = trajectory['accuracy'][:-1]
+    split = trajectory['distance'][1:] > np.minimum(distance_threshold, accuracy + accuracy + 30)
+    starts, ends = stop_segments(labels, split)
+    return [Region(trajectory[start:end], 1) for start, end in zip(starts, ends)]
+
+
+# What a stop shape needs from a run of points: the first and last point, the vertices of their convex hull, the
+# point count and the coordinate sum. Two summaries combine from their hulls, so merging never revisits the points.
+# first_index and last_index are the trajectory indices of the first and last point, if the points come from one.
+class PointSummary:
+    def __init__(self, first, last, hull, count, coordinate_sum, first_index=None, last_index=None):
+        self.first = first
+        self.last = last
+        self.hull = hull
+        self.count = count
+        self.coordinate_sum = coordinate_sum
+        self.first_index = first_index
+        self.last_index = last_index
+
+    # Returns None if there are no points. indices are the trajectory indices of the points, if known.
+    @staticmethod
+    def from_coordinates(lon_lats, indices=None):
+        if len(lon_lats) == 0:
+            return None
+        first_index, last_index = (None, None) if indices is None else (indices[0], indices[-1])
+        return PointSummary(lon_lats[0], lon_lats[-1], hull_vertices(lon_lats), len(lon_lats), lon_lats.sum(axis=0),
+                            first_index, last_index)
+
+    # Summary of the points of before followed by the points of after. Either can be None.
+    # If both know their trajectory indices, the first point is the one with the lowest index and the last point the one
+    # with the highest, so interleaved stays keep the trajectory order.
+    @staticmethod
+    def combine(before, after):
+        if before is None:
+            return after
+        if after is None:
+            return before
+        first, last = before, after
+        if before.first_index is not None and after.first_index is not None:
+            first = before if before.first_index <= after.first_index else after
+            last = after if after.last_index >= before.last_index else before
+        return PointSummary(first.first, last.last, hull_vertices(np.concatenate([before.hull, after.hull])),
+                            before.count + after.count, before.coordinate_sum + after.coordinate_sum,
+                            first.first_index, last.last_index)
+
+    # Point if the first and last points are the same, otherwise the convex hull
+    def shape(self):
+        if np.array_equal(self.first, self.last):
+            return Point(self.first)
+        return shapely.convex_hull(shapely.multipoints(self.hull))
+
+    def centroid(self):
+        return Point(self.coordinate_sum / self.count)
+
+
+def lon_lat_array(points):
+    return np.column_stack([points['lon'], points['lat']])
+
+
+# Stops keep summaries of all their points and of the points accurate enough to outline them, so a union only
+# combines two hulls. The points themselves are only concatenated when they are accessed.
 class Region:
     def __init__(self, points, label=1):
-        self.points = points
+        self.point_chunks = [points]
         self.entry_times = np.array([points[0]['time']])
         self.exit_times = np.array([points[-1]['time']])
         self.label = label
+
+        lon_lats = lon_lat_array(points)
+        self.summary = PointSummary.from_coordinates(lon_lats)
+        # Outlier rejection for stops
+        self.filtered_summary = PointSummary.from_coordinates(lon_lats[points['accuracy'] <= 60])
         self.centroid, self.shape = self.define_shape()
 
+    @property
+    def points(self):
+        if len(self.point_chunks) > 1:
+            self.point_chunks = [np.concatenate(self.point_chunks)]
+        return self.point_chunks[0]
+
     def union(self, other, new_label=1):
-        self.points = np.append(self.points, other.points)
+        self.point_chunks.extend(other.point_chunks)
         self.label = new_label
+        self.summary = PointSummary.combine(self.summary, other.summary)
+        self.filtered_summary = PointSummary.combine(self.filtered_summary, other.filtered_summary)
         self.centroid, self.shape = self.define_shape()
 
         # Combine stays and keep them sorted
@@ -65,122 +143,47 @@ class Region:
         else:
             return intersection.area / min(self.shape.area, other.shape.area)
 
+    # Meters between the convex shapes of the regions, or between their centroids when those are further apart than
+    # centroid_threshold
     def distance(self, other, centroid_threshold=200):
-        centroid_dist = distance((self.centroid.y, self.centroid.x), (other.centroid.y, other.centroid.x)).meters
+        centroid_dist = haversine_distance(self.centroid.coords[0], other.centroid.coords[0])
         # Thresholded to reduce computations when the regions are far apart
         if centroid_dist > centroid_threshold:
             return centroid_dist
-        # Iterates over vertices in a decreasing direction.
-        # NOTE: this does not return the minimum distance.
-        # It returns the distance between a pair of vertices on the edge with minimum distance.
-        # It is close enough and is significantly less computationally intensive.
-        else:
-            if self.shape.geom_type in ['LineString', "Point"]:
-                self_coords = self.shape.coords
-            else:
-                self_coords = self.shape.exterior.coords[:-1]  # Last point is the same as the first
-            if other.shape.geom_type in ['LineString', "Point"]:
-                other_coords = other.shape.coords
-            else:
-                other_coords = other.shape.exterior.coords[:-1]  # Last point is the same as the first
-            self_pointer = 0
-            other_pointer = 0
-            # Clockwise or counter-clockwise iteration
-            self_direction = 1 if len(self_coords) > 1 else 0
-            other_direction = 1 if len(other_coords) > 1 else 0
-            # Prevents infinite looping if there is a line with endpoints equidistant to a point
-            self_lap_start = None
-            other_lap_start = None
-
-            dist = distance(self_coords[self_pointer], other_coords[other_pointer]).meters
-            while self_direction != 0 or other_direction != 0:
-                if self_direction != 0:
-                    self_pointer = (self_pointer + self_direction) % len(self_coords)
-                    if self_pointer == self_lap_start:
-                        self_direction = 0
-                    new_dist = distance(self_coords[self_pointer], other_coords[other_pointer]).meters
-                    if new_dist > dist:
-                        if self_lap_start is None:
-                            self_direction *= -1
-                            self_lap_start = self_pointer
-                        else:
-                            self_direction = 0
-                    elif new_dist < dist:
-                        self_lap_start = self_pointer
-                        dist = new_dist
-                if other_direction != 0:
-                    other_pointer = (other_pointer + other_direction) % len(other_coords)
-                    if other_pointer == other_lap_start:
-                        other_direction = 0
-                    new_dist = distance(self_coords[self_pointer], other_coords[other_pointer]).meters
-                    if new_dist > dist:
-                        if other_lap_start is None:
-                            other_direction *= -1
-                            other_lap_start = other_pointer
-                        else:
-                            other_direction = 0
-                    elif new_dist < dist:
-                        other_lap_start = other_pointer
-                        dist = new_dist
-            return dist
+        return convex_distance(self.shape, other.shape)
 
     def define_shape(self):
-        lon_lats = [list(i) for i in self.points[['lon', 'lat']]]
-        # Outlier rejection for stops
         if self.label == 1:
-            lon_lats = np.array(lon_lats)[self.points['accuracy'] <= 60]
-            if len(lon_lats) == 0:
-                lon_lats = [list(i) for i in self.points[['lon', 'lat']]]
+            summary = self.filtered_summary if self.filtered_summary is not None else self.summary
+            return summary.centroid(), summary.shape()
 
+        lon_lats = lon_lat_array(self.points)
         # If first and last points are at the same point, the shape should be a point
-        if distance(lon_lats[0], lon_lats[-1]).meters == 0:
+        if np.array_equal(lon_lats[0], lon_lats[-1]):
             shape = Point(lon_lats[0])
-        elif self.label == 1:
-            shape = LineString(lon_lats).convex_hull
         else:
             shape = LineString(lon_lats)
-
-        centroid = shape.centroid
-        # Convert to convex hull for stops or linestring for walks/moves
-        return centroid, shape
+        return shape.centroid, shape
 
     @staticmethod
     def recursive_merge(stop_regions, distance_threshold=None):
-        merged = Region.merge_stop_regions(stop_regions, 0.0, distance_threshold)
-        if len(merged) == len(stop_regions):
-            return stop_regions
-        else:
-            return Region.recursive_merge(merged, distance_threshold)
+        return Region.merge_stop_regions(stop_regions, 0.0, distance_threshold)
 
     # Function to merge point clouds based if they overlap or if their distances are less than a threshold
+    # Overlapping regions are merged first, then the closest region under distance_threshold
     @staticmethod
     def merge_stop_regions(stop_regions, overlap_threshold=0.0, distance_threshold=None):
-        if len(stop_regions) == 0:
-            return stop_regions
-        merged_stops = [stop_regions[0]]
-        for stop in stop_regions[1:]:
-            merged = False
-            min_distance = None
-            min_distance_index = None
-            for i in range(len(merged_stops)):
-                percent_intersection = stop.percent_intersection(merged_stops[i])
-                if percent_intersection > overlap_threshold:
-                    merged_stops[i] = merged_stops[i].union(stop)
-                    merged = True
-                    break
-                if distance_threshold is not None:
-                    dist = stop.distance(merged_stops[i])
-                    if min_distance is None or dist < min_distance:
-                        min_distance = dist
-                        min_distance_index = i
-            # If no intersections, merge with the closest region if under distance_threshold
-            if not merged and min_distance is not None and min_distance < distance_threshold:
-                merged_stops[min_distance_index] = merged_stops[min_distance_index].union(stop)
-                merged = True
-            # Make a new region if not merged
-            if not merged:
-                merged_stops.append(stop)
-        return merged_stops
+        def merge_key(stop, merged_stop):
+            if stop.percent_intersection(merged_stop) > overlap_threshold:
+                return 0.0
+            if distance_threshold is not None:
+                dist = stop.distance(merged_stop)
+                if dist < distance_threshold:
+                    return dist
+            return None
+
+        return merge_regions(stop_regions, merge_key, lambda region: region.shape.bounds,
+                             0.0 if distance_threshold is None else distance_threshold)
 
     # Merges all stays within a stop that do not have a stay from another stop in between them
     @staticmethod
@@ -1,16 +1,29 @@
-from shapely.geometry import Point, LineString
 import numpy as np
-from geopy.distance import distance
+from convex_distance import convex_distance, haversine_distance
+from Region import PointSummary, lon_lat_array
 
 
+# Stays are index ranges of the trajectory. Summaries of the stay points are combined on union, see Region.
 class StopRegion:
     def __init__(self, trajectory, start, end):
         self.trajectory = trajectory
         self.entry_indices = np.array([start])
         self.exit_indices = np.array([end])
+
+        points = trajectory[start:end]
+        lon_lats = lon_lat_array(points)
+        indices = np.arange(start, end)
+        self.summary = PointSummary.from_coordinates(lon_lats, indices)
+        # Outlier rejection
+        accurate = points['accuracy'] <= 60
+        self.filtered_summary = PointSummary.from_coordinates(lon_lats[accurate], indices[accurate])
         self.centroid, self.shape = self.define_shape()
 
     def union(self, other):
+        # Points are in trajectory order, which the summaries keep from the indices of their points
+        self.summary = PointSummary.combine(self.summary, other.summary)
+        self.filtered_summary = PointSummary.combine(self.filtered_summary, other.filtered_summary)
+
         # Combine stays and keep them sorted
         self.entry_indices = np.sort(np.concatenate((self.entry_indices, other.entry_indices)))
         self.exit_indices = np.sort(np.concatenate((self.exit_indices, other.exit_indices)))
@@ -32,81 +45,18 @@ class StopRegion:
         else:
             return intersection.area / other.shape.area
 
+    # Meters between the convex shapes of the regions, or between their centroids when those are further apart than
+    # centroid_threshold
     def distance(self, other, centroid_threshold=200):
-        centroid_dist = distance((self.centroid.y, self.centroid.x), (other.centroid.y, other.centroid.x)).meters
+        centroid_dist = haversine_distance(self.centroid.coords[0], other.centroid.coords[0])
         # Thresholded to reduce computations when the regions are far apart
         if centroid_dist > centroid_threshold:
             return centroid_dist
-        # Iterates over vertices in a decreasing direction.
-        # NOTE: this does not return the minimum distance.
-        # It returns the distance between a pair of vertices on the edge with minimum distance.
-        # It is close enough and is significantly less computationally intensive.
-        else:
-            if self.shape.geom_type in ['LineString', "Point"]:
-                self_coords = self.shape.coords
-            else:
-                self_coords = self.shape.exterior.coords[:-1]  # Last point is the same as the first
-            if other.shape.geom_type in ['LineString', "Point"]:
-                other_coords = other.shape.coords
-            else:
-                other_coords = other.shape.exterior.coords[:-1]  # Last point is the same as the first
-            self_pointer = 0
-            other_pointer = 0
-            # Clockwise or counter-clockwise iteration
-            self_direction = 1 if len(self_coords) > 1 else 0
-            other_direction = 1 if len(other_coords) > 1 else 0
-            # Prevents infinite looping if there is a line with endpoints equidistant to a point
-            self_lap_start = None
-            other_lap_start = None
-
-            dist = distance(self_coords[self_pointer], other_coords[other_pointer]).meters
-            while self_direction != 0 or other_direction != 0:
-                if self_direction != 0:
-                    self_pointer = (self_pointer + self_direction) % len(self_coords)
-                    if self_pointer == self_lap_start:
-                        self_direction = 0
-                    new_dist = distance(self_coords[self_pointer], other_coords[other_pointer]).meters
-                    if new_dist > dist:
-                        if self_lap_start is None:
-                            self_direction *= -1
-                            self_lap_start = self_pointer
-                        else:
-                            self_direction = 0
-                    elif new_dist < dist:
-                        self_lap_start = self_pointer
-                        dist = new_dist
-                if other_direction != 0:
-                    other_pointer = (other_pointer + other_direction) % len(other_coords)
-                    if other_pointer == other_lap_start:
-                        other_direction = 0
-                    new_dist = distance(self_coords[self_pointer], other_coords[other_pointer]).meters
-                    if new_dist > dist:
-                        if other_lap_start is None:
-                            other_direction *= -1
-                            other_lap_start = other_pointer
-                        else:
-                            other_direction = 0
-                    elif new_dist < dist:
-                        other_lap_start = other_pointer
-                        dist = new_dist
-            return dist
+        return convex_distance(self.shape, other.shape)
 
     def define_shape(self):
-        all_points = self.get_all_points()
-        lon_lats = [list(i) for i in all_points[['lon', 'lat']]]
-        # Outlier rejection
-        filtered = np.array(lon_lats)[all_points['accuracy'] <= 60]
-        if len(filtered) > 0:
-            lon_lats = filtered
-
-        # If first and last points are at the same point, the shape should be a point
-        if distance(lon_lats[0], lon_lats[-1]).meters == 0:
-            shape = Point(lon_lats[0])
-        else:
-            shape = LineString(lon_lats).convex_hull
-
-        centroid = shape.centroid
-        return centroid, shape
+        summary = self.filtered_summary if self.filtered_summary is not None else self.summary
+        return summary.centroid(), summary.shape()
 
     def get_all_points(self):
         result = []
@@ -1,8 +1,13 @@
 import csv
 import numpy as np
-from geopy.distance import distance
+from geopy.distance import distance as geopy_distance
 from datetime import datetime
+import common_path  # noqa: F401
+from dates import day_bounds, DayPartition
+from store import save_store, TrajectoryStore
 from StopRegion import StopRegion
+from Region import stop_segments, get_filtered_subtrajectories
+from SegmentTable import SegmentTable
 
 
 position_fix_dtype = np.dtype([('lat', np.float64),
@@ -14,18 +19,126 @@ position_fix_dtype = np.dtype([('lat', np.float64),
                               ('time_diff', np.float64)])
 
 
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+MEAN_EARTH_RADIUS = 6371008.8
+
+
+# Meters between arrays of points on a sphere of the mean earth radius.
+# Within 0.6% of the ellipsoidal geodesic, typically under 0.3%.
+def haversine_distances(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(i) for i in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * MEAN_EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+# Meters between arrays of points on the WGS84 ellipsoid with Vincenty's inverse formula, iterated on all pairs at once.
+# Within 1 mm of geopy's geodesic. Pairs that do not converge (nearly antipodal points) are solved with geopy.
+def vincenty_distances(lat1, lon1, lat2, lon2, tolerance=1e-12, max_iterations=200):
+    lat1, lon1, lat2, lon2 = (np.atleast_1d(np.asarray(i, dtype=np.float64)) for i in (lat1, lon1, lat2, lon2))
+    big_l = np.radians(lon2 - lon1)
+    u1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat1)))
+    u2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat2)))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    lam = big_l
+    converged = np.zeros(len(big_l), dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iterations):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            # Coincident points have sin_sigma == 0 and are 0 apart
+            sin_alpha = np.where(sin_sigma > 0, cos_u1 * cos_u2 * sin_lam / sin_sigma, 0.0)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # Both points on the equator have cos2_alpha == 0
+            cos_2sigma_m = np.where(cos2_alpha > 0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha, 0.0)
+            c = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+            previous = lam
+            lam = big_l + (1 - c) * WGS84_F * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - previous) <= tolerance
+            if np.all(converged):
+                break
+
+    u_squared = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    big_a = 1 + u_squared / 16384 * (4096 + u_squared * (-768 + u_squared * (320 - 175 * u_squared)))
+    big_b = u_squared / 1024 * (256 + u_squared * (-128 + u_squared * (74 - 47 * u_squared)))
+    delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+        - big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+    distances = WGS84_B * big_a * (sigma - delta_sigma)
+
+    for i in np.nonzero(~converged)[0]:
+        distances[i] = geopy_distance((lat1[i], lon1[i]), (lat2[i], lon2[i])).meters
+    return distances
+
+
+# Meters between arrays of points with geopy's geodesic, one pair at a time. Exact but slow.
+def geopy_distances(lat1, lon1, lat2, lon2):
+    return np.array([geopy_distance((lat1[i], lon1[i]), (lat2[i], lon2[i])).meters for i in range(len(lat1))])
+
+
+distance_methods = {
+    'haversine': haversine_distances,
+    'vincenty': vincenty_distances,
+    'geopy': geopy_distances,
+}
+
+
+# Fills the distance and time_diff fields of points in place from each point to the one before it.
+# The first point is compared to previous if it is given, otherwise its fields are 0.
+def fill_derived_fields(points, method='vincenty', previous=None):
+    if method not in distance_methods:
+        raise ValueError(f"Distance method must be one of {', '.join(distance_methods)}.")
+    if len(points) == 0:
+        return
+    lat, lon, time = points['lat'], points['lon'], points['time']
+    if previous is not None:
+        lat = np.concatenate([[previous['lat']], lat])
+        lon = np.concatenate([[previous['lon']], lon])
+        time = np.concatenate([[previous['time']], time])
+    else:
+        points['distance'][0] = 0.0
+        points['time_diff'][0] = 0.0
+    first = 0 if previous is not None else 1
+    points['distance'][first:] = distance_methods[method](lat[:-1], lon[:-1], lat[1:], lon[1:])
+    points['time_diff'][first:] = np.diff(time)
+
+
+# If distance_method is given, the distance and time_diff fields of the points have not been computed yet.
+# They are computed with that method the first time the points are accessed. previous is the fix before the first
+# point, so a window of a lazy trajectory gets the same fields as the whole trajectory.
 class Trajectory:
-    def __init__(self, points):
-        self.points = points
+    def __init__(self, points, distance_method=None, previous=None):
+        self.raw_points = points
+        self.distance_method = distance_method
+        self.previous = previous
+
+    @property
+    def points(self):
+        if self.distance_method is not None:
+            fill_derived_fields(self.raw_points, self.distance_method, self.previous)
+            self.distance_method = None
+        return self.raw_points
 
     def __getitem__(self, index):
         return self.points[index]
 
     def __len__(self):
-        return len(self.points)
+        return len(self.raw_points)
 
+    # distance_method is 'haversine', 'vincenty' or 'geopy', see distance_methods.
+    # If lazy, distance and time_diff are left for the first access to the points.
     @classmethod
-    def from_file(cls, file_path, remove_duplicates=True, accuracy_threshold=None):
+    def from_file(cls, file_path, remove_duplicates=True, accuracy_threshold=None, distance_method='vincenty',
+                  lazy=False):
+        if distance_method not in distance_methods:
+            raise ValueError(f"Distance method must be one of {', '.join(distance_methods)}.")
         points = []
         with open(file_path, 'r') as file:
             reader = csv.DictReader(file)
@@ -50,32 +163,53 @@ class Trajectory:
                         continue
                 points.append(point)
         points = np.array(points, dtype=position_fix_dtype)
-        last = points[0]
-        for i in points[1:]:
-            i['distance'] = distance(i[['lat', 'lon']], last[['lat', 'lon']]).meters
-            i['time_diff'] = i['time'] - last['time']
-            last = i
+        points = points[np.argsort(points['time'], kind='stable')]
 
+        if lazy:
+            return cls(points, distance_method)
+        fill_derived_fields(points, distance_method)
         return cls(points)
 
-    def filter_by_date(self, date):
-        year = date.year
-        month = date.month
-        day = date.day
+    # Memory maps a store written by to_store or by gb-spm. Slices of it are views, so nothing is parsed on startup.
+    # Stores without the derived fields (as written by gb-spm) are copied into position_fix_dtype, and their distance
+    # and time_diff are computed with distance_method on first access.
+    @classmethod
+    def from_store(cls, store_path, distance_method='vincenty'):
+        points = TrajectoryStore(store_path).points
+        if points.dtype == position_fix_dtype:
+            return cls(points)
+        missing = set(position_fix_dtype.names) - set(points.dtype.names) - {'distance', 'time_diff'}
+        if len(missing) > 0:
+            raise ValueError(f"Store is missing the fields {sorted(missing)}")
+        converted = np.zeros(len(points), dtype=position_fix_dtype)
+        for field in position_fix_dtype.names:
+            if field in points.dtype.names:
+                converted[field] = points[field]
+        return cls(converted, distance_method)
 
-        # Create datetime objects for the start and end of the day
-        start_of_day = datetime(year, month, day, 0, 0, 0)
-        end_of_day = datetime(year, month, day, 23, 59, 59)
+    # Writes the points, including the derived distance and time_diff fields, sorted by time, in the store format of
+    # gb-spm with its time index and metadata
+    def to_store(self, store_path, source=None):
+        save_store(self.points, store_path, source=source)
 
-        # Convert datetime objects to epoch time (Unix timestamp)
-        epoch_start_of_day = start_of_day.timestamp()
-        epoch_end_of_day = end_of_day.timestamp()
+    # Points are sorted by time, so days are found by binary search and returned as views
+    def filter_by_date(self, date, tz=None):
+        start, end = np.searchsorted(self.raw_points['time'], day_bounds(date, tz), side='left')
+        return self.window(start, end)
 
-        mask = (self.points['time'] >= epoch_start_of_day) & (self.points['time'] <= epoch_end_of_day)
-        new_data = self.points[mask].copy()
+    # Trajectory of the points from index start to end, sharing their memory
+    def window(self, start, end):
+        if self.distance_method is None:
+            return Trajectory(self.raw_points[start:end])
+        previous = self.raw_points[start - 1] if start > 0 else self.previous
+        return Trajectory(self.raw_points[start:end], self.distance_method, previous)
 
-        # Extracting values between the timestamps
-        return Trajectory(new_data)
+    # Yields (date, Trajectory) for every day from the first to the last point in a single pass, with the day boundaries
+    # of DayPartition
+    def split_by_day(self, tz=None):
+        days = DayPartition(self.raw_points, tz=tz)
+        for i in range(len(days)):
+            yield days.dates[i], self.window(days.offsets[i], days.offsets[i + 1])
 
     def get_date_range(self):
         start = self.points[0]['time']
@@ -89,47 +223,42 @@ class Trajectory:
     # For calculated, noise in the building would mean it never drops below the threshold.
     # Therefore, use an expected value for the reported threshold and a much more conservative value for calculated.
     def get_labels(self, stop_threshold, calculated_threshold=None):
-        labels = np.zeros(len(self.points))
-        for i in range(len(self.points)):
-            if self.points[i]['speed'] < stop_threshold:
-                labels[i] = 1
-            elif (calculated_threshold is not None
-                  and self.points[i]['distance'] / self.points[i]['time_diff'] < calculated_threshold):
-                labels[i] = 1
-        return labels
+        calculated = np.nan if calculated_threshold is None else calculated_threshold
+        return self.get_label_matrix([stop_threshold], [calculated])[0]
+
+    # Calculated speed of each point. Points without a time difference have no calculated speed and get inf, so they
+    # are never labeled stops by it.
+    def get_calculated_speeds(self):
+        time_diff = self.points['time_diff']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(time_diff > 0, self.points['distance'] / time_diff, np.inf)
+
+    # Labels for many threshold pairs at once, one row per pair. A NaN calculated threshold disables it for that row,
+    # as None does in get_labels.
+    def get_label_matrix(self, stop_thresholds, calculated_thresholds=None):
+        stop_thresholds = np.asarray(stop_thresholds, dtype=np.float64)
+        if calculated_thresholds is None:
+            calculated_thresholds = np.full(len(stop_thresholds), np.nan)
+        calculated_thresholds = np.asarray(calculated_thresholds, dtype=np.float64)
+        if stop_thresholds.shape != calculated_thresholds.shape:
+            raise ValueError("stop_thresholds and calculated_thresholds must have the same length")
+
+        labels = self.points['speed'][np.newaxis, :] < stop_thresholds[:, np.newaxis]
+        # Comparisons with NaN are False, so disabled thresholds label nothing
+        labels |= self.get_calculated_speeds()[np.newaxis, :] < calculated_thresholds[:, np.newaxis]
+        return labels.astype(np.float64)
 
     # Returns subtrajectories of a given label
     def get_subtrajectories(self, labels, label, return_boundaries=False):
-        difference = np.diff((labels == label).astype(int))
-        starts = np.where(difference == 1)[0] + 1
-        ends = np.where(difference == -1)[0] + 1
-        if labels[0] == label:
-            starts = np.insert(starts, 0, 0)
-        if labels[-1] == label:
-            ends = np.append(ends, len(labels))
-        subtrajectories = [self.points[starts[i]:ends[i]] for i in range(len(starts))]
-        if return_boundaries:
-            return subtrajectories, starts, ends
-        else:
-            return subtrajectories
+        return get_filtered_subtrajectories(self.points, labels, label, return_boundaries)
 
-    def get_stop_regions(self, labels, distance_threshold=500, accuracy_error=30):
-        consecutive_points, starts, stops = self.get_subtrajectories(labels, 1, True)
-        starts = starts.tolist()
-        stops = stops.tolist()
-
-        regions = []
-        while len(starts) > 0:
-            start = starts.pop(0)
-            stop = stops.pop(0)
-            for j in range(start, stop - 1):
-                # split if points are far apart
-                thresh = min(distance_threshold, np.sum(self.points[j:j+2]['accuracy']) + accuracy_error)
-                if self.points[j + 1]['distance'] > thresh:
-                    starts.insert(0, j + 1)
-                    stops.insert(0, stop)
-                    stop = j + 1
-                    break
-            regions.append(StopRegion(self, start, stop))
-        return regions
+    # Run-length table of labels over the points
+    def get_segment_table(self, labels):
+        return SegmentTable.from_labels(self.points, labels)
 
+    def get_stop_regions(self, labels, distance_threshold=500, accuracy_error=30):
+        # split if points are far apart
+        accuracy = self.points['accuracy']
+        thresh = np.minimum(distance_threshold, accuracy[:-1] + accuracy[1:] + accuracy_error)
+        starts, stops = stop_segments(labels, self.points['distance'][1:] > thresh)
+        return [StopRegion(self, start, stop) for start, stop in zip(starts, stops)]
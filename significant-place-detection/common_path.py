@@ -0,0 +1,9 @@
+import os
+import sys
+
+
+# Modules shared by gb-spm and significant-place-detection are kept once in ../common. Importing this module makes them
+# importable from either directory. It is appended, so modules of this directory keep priority.
+common_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common')
+if common_dir not in sys.path:
+    sys.path.append(common_dir)
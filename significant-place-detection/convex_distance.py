@@ -0,0 +1,123 @@
+import numpy as np
+import shapely
+
+# Exact distances between convex shapes, the NumPy counterpart of convexDistance.ts.
+# Shapes are projected once into a local tangent plane in meters. Two convex shapes are 0 apart if an edge of one
+# crosses an edge of the other or a vertex of one is inside the other, otherwise the minimum distance is reached
+# between a vertex of one shape and an edge of the other.
+
+EARTH_RADIUS = 6371e3
+
+
+# Meters between (lon, lat) points on a sphere
+def haversine_distance(lon_lat1, lon_lat2):
+    lon1, lat1 = np.radians(np.asarray(lon_lat1, dtype=float)).T
+    lon2, lat2 = np.radians(np.asarray(lon_lat2, dtype=float)).T
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+# Local tangent plane projection of (..., 2) lon, lat degrees around center to x, y meters.
+# Very inaccurate over large distances, but only distances of up to a few hundred meters are compared.
+def local_tangent_plane_projection(lon_lats, center):
+    lon, lat = np.radians(lon_lats[..., 0]), np.radians(lon_lats[..., 1])
+    center_lon, center_lat = np.radians(center[..., 0]), np.radians(center[..., 1])
+    d_lon = lon - center_lon
+    x = EARTH_RADIUS * np.cos(lat) * np.sin(d_lon)
+    y = EARTH_RADIUS * (np.cos(center_lat) * np.sin(lat) - np.sin(center_lat) * np.cos(lat) * np.cos(d_lon))
+    return np.stack([x, y], axis=-1)
+
+
+# (n, 2) lon, lat vertices of the convex hull of a shapely geometry, without the closing vertex of a polygon
+def hull_coordinates(shape):
+    hull = shape.convex_hull
+    coordinates = shapely.get_coordinates(hull)
+    return coordinates[:-1] if hull.geom_type == 'Polygon' else coordinates
+
+
+# Cross product of (b - a) and (c - a) over the last axis
+def orientation(a, b, c):
+    return (b[..., 0] - a[..., 0]) * (c[..., 1] - a[..., 1]) - (b[..., 1] - a[..., 1]) * (c[..., 0] - a[..., 0])
+
+
+# Distances from points (m, p, 2) to edges from starts to ends (m, e, 2), shape (m, p, e)
+def point_edge_distances(points, starts, ends):
+    points = points[:, :, np.newaxis, :]
+    starts = starts[:, np.newaxis, :, :]
+    edges = ends[:, np.newaxis, :, :] - starts
+    squared_lengths = np.sum(edges ** 2, axis=-1)
+    # Projection of each point onto each edge, snapped to the edge. Zero length edges snap to their start.
+    along = np.sum((points - starts) * edges, axis=-1) / np.where(squared_lengths > 0, squared_lengths, 1.0)
+    along = np.clip(along, 0.0, 1.0)
+    closest = starts + along[..., np.newaxis] * edges
+    return np.sqrt(np.sum((points - closest) ** 2, axis=-1))
+
+
+# True where an edge of the first shapes properly crosses an edge of the second, shape (m,)
+def edges_cross(starts1, ends1, starts2, ends2):
+    a, b = starts1[:, :, np.newaxis, :], ends1[:, :, np.newaxis, :]
+    c, d = starts2[:, np.newaxis, :, :], ends2[:, np.newaxis, :, :]
+    crosses = ((orientation(a, b, c) * orientation(a, b, d) < 0)
+               & (orientation(c, d, a) * orientation(c, d, b) < 0))
+    return np.any(crosses, axis=(1, 2))
+
+
+# True where a vertex of the first shapes is strictly inside the second, shape (m,).
+# Points and segments contain nothing, since their edges run both ways and never all turn the same way.
+def vertex_inside(vertices, starts, ends):
+    turns = orientation(starts[:, np.newaxis, :, :], ends[:, np.newaxis, :, :], vertices[:, :, np.newaxis, :])
+    inside = np.all(turns > 0, axis=2) | np.all(turns < 0, axis=2)
+    return np.any(inside, axis=1)
+
+
+# Pads a list of (n_i, 2) vertex arrays to (m, max n_i, 2) by repeating each first vertex, and returns the closed
+# edges of each shape padded by repeating each first edge. Repeated vertices and edges change no distance or test,
+# so the padding needs no mask.
+def pad_shapes(vertex_list):
+    size = max(len(vertices) for vertices in vertex_list)
+    counts = np.array([len(vertices) for vertices in vertex_list])
+    slots = np.arange(size)
+    valid = slots[np.newaxis, :] < counts[:, np.newaxis]
+    vertex_index = np.where(valid, slots, 0)
+    next_index = np.where(valid, (slots + 1) % counts[:, np.newaxis], 1 % counts[:, np.newaxis])
+    padded = np.zeros((len(vertex_list), size, 2))
+    for i, vertices in enumerate(vertex_list):
+        padded[i, :len(vertices)] = vertices
+    rows = np.arange(len(vertex_list))[:, np.newaxis]
+    return padded[rows, vertex_index], padded[rows, next_index], counts
+
+
+# Exact meters between the convex hulls of each pair of shapely geometries shapes1[i], shapes2[i].
+# Every pair is projected around the mean of its vertices and all pairs are solved together.
+def convex_distances(shapes1, shapes2):
+    if len(shapes1) != len(shapes2):
+        raise ValueError("shapes1 and shapes2 must have the same length")
+    if len(shapes1) == 0:
+        return np.zeros(0)
+
+    vertices1, next1, counts1 = pad_shapes([hull_coordinates(shape) for shape in shapes1])
+    vertices2, next2, counts2 = pad_shapes([hull_coordinates(shape) for shape in shapes2])
+
+    # Padding repeats vertices, so the mean is taken over the real ones
+    sum1 = np.array([np.sum(hull_coordinates(shape), axis=0) for shape in shapes1])
+    sum2 = np.array([np.sum(hull_coordinates(shape), axis=0) for shape in shapes2])
+    center = (sum1 + sum2) / (counts1 + counts2)[:, np.newaxis]
+    center = center[:, np.newaxis, :]
+
+    vertices1 = local_tangent_plane_projection(vertices1, center)
+    next1 = local_tangent_plane_projection(next1, center)
+    vertices2 = local_tangent_plane_projection(vertices2, center)
+    next2 = local_tangent_plane_projection(next2, center)
+
+    distances = np.minimum(np.min(point_edge_distances(vertices1, vertices2, next2), axis=(1, 2)),
+                           np.min(point_edge_distances(vertices2, vertices1, next1), axis=(1, 2)))
+    overlapping = (edges_cross(vertices1, next1, vertices2, next2)
+                   | vertex_inside(vertices1, vertices2, next2)
+                   | vertex_inside(vertices2, vertices1, next1))
+    distances[overlapping] = 0.0
+    return distances
+
+
+# Exact meters between the convex hulls of two shapely geometries
+def convex_distance(shape1, shape2):
+    return convex_distances([shape1], [shape2])[0]
@@ -1,4 +1,3 @@
-from datetime import timedelta
 from MapPlot import MapPlot
 import webbrowser
 from StopRegion import StopRegion
@@ -35,15 +34,17 @@ def get_regions(trajectory):
 
 if __name__ == '__main__':
     file_path = full_path("../data/andrew-device-locations-all2.csv")
-    traj = Trajectory.from_file(file_path)
+    store_path = os.path.splitext(file_path)[0] + '.store'
+    points_path = os.path.join(store_path, 'points.npy')
+    if os.path.exists(points_path) and os.path.getmtime(points_path) >= os.path.getmtime(file_path):
+        traj = Trajectory.from_store(store_path)
+    else:
+        traj = Trajectory.from_file(file_path)
+        traj.to_store(store_path, source=os.path.abspath(file_path))
 
     # Produce one map for each day in the data
-    start, end = traj.get_date_range()
-    current = start
-    while current <= end:
-        current += timedelta(days=1)
-        day_traj = traj.filter_by_date(current)
-        if len(day_traj.points) <= 1:
+    for _, day_traj in traj.split_by_day():
+        if len(day_traj) <= 1:
             continue
         stop_regions = get_regions(day_traj)
         mask = np.array([r.longer_than(duration=300) for r in stop_regions])